@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+"""Benchmarks for generation, analysis and notation.
+
+Every case runs with a fixed seed, in its own fresh interpreter, so caches
+start cold. Peak memory is the interpreter's, setup included; case memory
+is how far the timed part raised that peak. Results are written as
+JSON and can be compared against a saved baseline:
+
+    ./benchmarks.py -o baseline.json
+    ... change things ...
+    ./benchmarks.py -c baseline.json
+
+Startup times are measured in fresh interpreters, best of `repeat`.
+
+"""
+import os
+import sys
+import time
+import json
+import random
+import platform
+import resource
+import subprocess
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SEED = 1
+
+
+def time_command(args, repeat=5):
+    """Best wall time of running `args` in a new process, in seconds."""
+    best = None
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.check_call(args, cwd=HERE, stdout=devnull, stderr=devnull)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    return best
+
+
+def startup(repeat=5):
+    """Cold start of generation-only runs, against importing music21."""
+    python = sys.executable
+    return {
+        'python': time_command([python, '-c', 'pass'], repeat),
+        'import music21': time_command([python, '-c', 'import music21'], repeat),
+        'import music_tools': time_command([python, '-c', 'import music_tools'], repeat),
+        'import full_movie': time_command([python, '-c', 'import full_movie'], repeat),
+        'movement3.py -d': time_command([python, 'movement3.py', '-d'], repeat),
+    }
+
+
+class Quiet(object):
+    """Send stdout to /dev/null, for generators that print their stats."""
+    def __enter__(self):
+        self._stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self._stdout
+
+
+def make_movement3(minutes):
+    import movement3
+    random.seed(SEED)
+    return movement3.Movement3(duration=minutes * 60.0, verbose=False)
+
+
+def make_full_movie(n_attempts):
+    import full_movie
+    music = full_movie.Music()
+    with Quiet():
+        music.make_fragments(n_attempts, seed=SEED)
+    return music
+
+
+def count_notes(music):
+    return sum(len(instrument) for instrument in music.instruments)
+
+
+# Each case takes a scale and does its setup, including imports, then
+# returns a function that runs the timed part and returns how many events
+# it handled.
+
+def bench_movement3(minutes):
+    import movement3
+
+    def run():
+        m3 = make_movement3(minutes)
+        return count_notes(m3.music)
+    return run
+
+
+def bench_make_fragments(n_attempts):
+    import full_movie
+
+    def run():
+        make_full_movie(n_attempts)
+        return n_attempts
+    return run
+
+
+def bench_check_fragment(n_attempts):
+    music = make_full_movie(n_attempts)
+
+    def run():
+        music.check_fragment()
+        return count_notes(music)
+    return run
+
+
+def bench_events(minutes):
+    music = make_movement3(minutes).music
+
+    def run():
+        n_events = 0
+        for _ in music.events():
+            n_events += 1
+        for _ in music:
+            n_events += 1
+        return n_events
+    return run
+
+
+def bench_notate(minutes):
+    import notation_tools
+    notation_tools.make_music21_score()
+    music = make_movement3(minutes).music
+
+    def run():
+        music.notate(show=False)
+        return count_notes(music)
+    return run
+
+
+def bench_musicxml(minutes):
+    import musicxml_tools
+    music = make_movement3(minutes).music
+
+    def run():
+        with open(os.devnull, 'w') as f:
+            musicxml_tools.write_musicxml(music, f)
+        return count_notes(music)
+    return run
+
+
+def bench_midi(minutes):
+    import midi_tools
+    music = make_movement3(minutes).music
+
+    def run():
+        with open(os.devnull, 'wb') as f:
+            midi_tools.write_midi(music, f)
+        return count_notes(music)
+    return run
+
+
+def bench_snapshot(minutes):
+    import snapshot_tools
+    music = make_movement3(minutes).music
+    path = os.path.join(HERE, 'benchmark-snapshot.bin')
+
+    def run():
+        try:
+            snapshot_tools.write_snapshot(music, path)
+            loaded = snapshot_tools.read_snapshot(path)
+            loaded.duration()
+            return count_notes(loaded)
+        finally:
+            os.remove(path)
+    return run
+
+
+def mixed_notes(n_notes):
+    """Seeded (pitch, duration)s with notes, rests, chords and triplets."""
+    rng = random.Random(SEED)
+    notes = []
+    for _ in xrange(n_notes):
+        kind = rng.random()
+        if kind < .2:
+            pitch = 'rest'
+        elif kind < .3:
+            pitch = [rng.randint(48, 84) for _ in range(3)]
+        else:
+            pitch = rng.randint(48, 84)
+        notes.append((pitch, rng.choice([.25, .5, 1, 1, 2, 3, 1 / 3.0])))
+    return notes
+
+
+def bench_part(n_notes, part_class):
+    """Build a part of `n_notes` with tail queries after each note, as
+    generators do, then look up a note at `n_notes` ticks."""
+    notes = mixed_notes(n_notes)
+
+    def run():
+        part = part_class('violin')
+        for pitch, duration in notes:
+            part.add_note(pitch, duration)
+            part.beats_since_last_rest()
+            part.get_last_pitched()
+        total = part.duration()
+        for n in xrange(n_notes):
+            part.get_at_tick(total * n / float(n_notes))
+        return n_notes
+    return run
+
+
+def bench_list_part(n_notes):
+    from music_tools import Instrument
+    return bench_part(n_notes, Instrument)
+
+
+def bench_compact_part(n_notes):
+    from music_tools import CompactInstrument
+    return bench_part(n_notes, CompactInstrument)
+
+
+# name: (function, scales, quick scales)
+CASES = {
+    'movement3': (bench_movement3, [2, 20, 120], [2]),
+    'make_fragments': (bench_make_fragments, [100, 500, 2500], [100]),
+    'check_fragment': (bench_check_fragment, [100, 2500], [100]),
+    'events': (bench_events, [2, 20, 120], [2]),
+    'notate': (bench_notate, [2, 20], [2]),
+    'musicxml': (bench_musicxml, [2, 120], [2]),
+    'midi': (bench_midi, [2, 120], [2]),
+    'snapshot': (bench_snapshot, [2, 120], [2]),
+    'list_part': (bench_list_part, [10000, 100000], [10000]),
+    'compact_part': (bench_compact_part, [10000, 100000], [10000]),
+}
+
+
+def peak_memory_kb():
+    """This process's peak resident memory so far."""
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak
+
+
+def run_case(name, scale):
+    """Run one case in this process and return its measurements."""
+    function = CASES[name][0]
+    run = function(scale)
+    setup_peak = peak_memory_kb()
+    start = time.time()
+    n_events = run()
+    seconds = time.time() - start
+    peak = peak_memory_kb()
+    return {
+        'seconds': seconds,
+        'peak_memory_kb': peak,
+        'case_memory_kb': peak - setup_peak,
+        'events': n_events,
+        'events_per_second': n_events / seconds if seconds else None,
+    }
+
+
+def run_case_in_subprocess(name, scale):
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--case', name, str(scale)],
+        cwd=HERE
+    )
+    return json.loads(output.splitlines()[-1])
+
+
+def run_all(names=None, quick=False, repeat=5):
+    results = {}
+    for name in sorted(name for name in (names or CASES) if name in CASES):
+        function, scales, quick_scales = CASES[name]
+        for scale in (quick_scales if quick else scales):
+            key = '{} {}'.format(name, scale)
+            print >> sys.stderr, key
+            results[key] = run_case_in_subprocess(name, scale)
+    if not names or 'startup' in names:
+        for key, seconds in startup(repeat).items():
+            results['startup ' + key] = {'seconds': seconds}
+    return {
+        'seed': SEED,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'results': results,
+    }
+
+
+def print_results(report):
+    print '{:<32} {:>10} {:>12} {:>12} {:>14}'.format('case', 'seconds', 'peak MB', 'case MB', 'events/s')
+    for key in sorted(report['results']):
+        result = report['results'][key]
+        peak = result.get('peak_memory_kb')
+        case_memory = result.get('case_memory_kb')
+        rate = result.get('events_per_second')
+        print '{:<32} {:>10.3f} {:>12} {:>12} {:>14}'.format(
+            key,
+            result['seconds'],
+            '{:.1f}'.format(peak / 1024.0) if peak else '',
+            '{:.1f}'.format(case_memory / 1024.0) if case_memory is not None else '',
+            '{:.0f}'.format(rate) if rate else '',
+        )
+
+
+def compare(report, baseline, threshold=0.1):
+    """Print each case's time against the baseline and return the cases
+    more than `threshold` slower."""
+    slower = []
+    print '{:<32} {:>10} {:>10} {:>8}'.format('case', 'baseline', 'now', 'change')
+    for key in sorted(report['results']):
+        seconds = report['results'][key]['seconds']
+        old = baseline['results'].get(key)
+        if not old:
+            print '{:<32} {:>10} {:>10.3f}'.format(key, '-', seconds)
+            continue
+        change = seconds / old['seconds'] - 1 if old['seconds'] else 0.0
+        flag = ''
+        if change > threshold:
+            flag = '  slower'
+            slower.append(key)
+        elif change < -threshold:
+            flag = '  faster'
+        print '{:<32} {:>10.3f} {:>10.3f} {:>+7.0%}{}'.format(key, old['seconds'], seconds, change, flag)
+    return slower
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'names',
+        nargs='*',
+        help='cases to run, all of them if none: {}'.format(', '.join(sorted(CASES) + ['startup'])))
+    parser.add_argument(
+        '-q',
+        '--quick',
+        help='only run the smallest scale of each case',
+        action='store_true')
+    parser.add_argument(
+        '-r',
+        '--repeat',
+        help='runs of each startup benchmark, best one counts',
+        type=int,
+        default=5)
+    parser.add_argument(
+        '-o',
+        '--output',
+        help='write the results as JSON to this path')
+    parser.add_argument(
+        '-c',
+        '--compare',
+        help='compare against a baseline JSON file written with --output')
+    parser.add_argument(
+        '-t',
+        '--threshold',
+        help='relative slowdown that counts as a regression (default 0.1)',
+        type=float,
+        default=0.1)
+    parser.add_argument(
+        '--case',
+        help=argparse.SUPPRESS,
+        nargs=2)
+    args = parser.parse_args()
+
+    if args.case:
+        name, scale = args.case
+        print json.dumps(run_case(name, int(scale)))
+        sys.exit()
+
+    report = run_all(args.names, args.quick, args.repeat)
+    print_results(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
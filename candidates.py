@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""Best-of-N candidate farm for Movement3.
+
+Generates N seeded realizations in a process pool, scores each from its
+stats, keeps the best K and only exports those. Workers send back scores
+and stats, never music, and the kept candidates are regenerated from
+their seeds for export, so memory doesn't grow with N.
+
+"""
+import os
+import math
+import heapq
+import random
+import multiprocessing
+
+import movement3
+import musicxml_tools
+import midi_tools
+from music_tools import export_scores
+from utils import derive_seed
+
+
+# How much each part of the default score counts
+SCORE_WEIGHTS = {
+    'harmony': 1.0,
+    'repeats': 0.5,
+    'phrases': 0.5,
+}
+
+
+def score_components(stats):
+    """Each in 0-1, higher is better.
+
+    harmony: how closely the cluster harmonies heard match the
+        proportions of ALLOWED_HARMONIES (1 - total variation distance)
+    repeats: how rarely a repeated pitch was allowed
+    phrases: how varied the phrase lengths, in beats_since_last_rest, are
+        (entropy of the histogram over its maximum)
+
+    """
+    target_total = sum(movement3.ALLOWED_HARMONIES.values())
+    harmonies = stats['harmonies']
+    heard_total = float(sum(harmonies.values()))
+    distance = 0.0
+    for harmony in set(harmonies) | set(movement3.ALLOWED_HARMONIES):
+        heard = harmonies.get(harmony, 0) / heard_total if heard_total else 0.0
+        target = movement3.ALLOWED_HARMONIES.get(harmony, 0.0) / target_total
+        distance += abs(heard - target)
+    harmony_score = 1.0 - distance / 2
+
+    n_repeat_choices = stats['allow_repeated_pitch'] + stats['dont_allow_repeated_pitch']
+    repeats_score = 1.0
+    if n_repeat_choices:
+        repeats_score -= stats['allow_repeated_pitch'] / float(n_repeat_choices)
+
+    phrases = stats['beats_since_last_rest']
+    n_phrases = float(sum(phrases.values()))
+    phrases_score = 0.0
+    if len(phrases) > 1:
+        entropy = -sum(count / n_phrases * math.log(count / n_phrases) for count in phrases.values())
+        phrases_score = entropy / math.log(len(phrases))
+
+    return {
+        'harmony': harmony_score,
+        'repeats': repeats_score,
+        'phrases': phrases_score,
+    }
+
+
+def score_stats(stats):
+    components = score_components(stats)
+    return sum(SCORE_WEIGHTS[name] * value for name, value in components.items())
+
+
+def _realize(job):
+    candidate_number, seed, duration, score = job
+    stats = movement3.generate(seed, duration).export_stats()
+    return score(stats), candidate_number, seed, stats
+
+
+def farm(n_candidates=16, keep=4, seed=None, duration=120.0, n_workers=None, score=score_stats):
+    """Generate `n_candidates` realizations and return the best `keep` as
+    (score, seed, stats), best first.
+
+    Each candidate's seed comes from `seed` and its number, so the result
+    doesn't depend on the number of workers. `score` takes a candidate's
+    exported stats (see Movement3.export_stats) and must be a module-level
+    function so it can be sent to workers. `n_workers` defaults to one per
+    CPU.
+
+    """
+    if seed is None:
+        seed = random.getrandbits(32)
+    jobs = [(n, derive_seed('candidate', seed, n), duration, score) for n in range(n_candidates)]
+
+    pool = None
+    if n_workers != 1:
+        pool = multiprocessing.Pool(n_workers)
+        results = pool.imap_unordered(_realize, jobs)
+    else:
+        results = (_realize(job) for job in jobs)
+
+    # Min-heap of the best so far. Ties go to the earlier candidate.
+    best = []
+    try:
+        for candidate_score, candidate_number, candidate_seed_, stats in results:
+            print 'candidate {} seed {} score {:.4f}'.format(candidate_number, candidate_seed_, candidate_score)
+            entry = (candidate_score, -candidate_number, candidate_seed_, stats)
+            if len(best) < keep:
+                heapq.heappush(best, entry)
+            elif entry[:2] > best[0][:2]:
+                heapq.heapreplace(best, entry)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    best.sort(reverse=True)
+    return [(candidate_score, candidate_seed_, stats) for candidate_score, _, candidate_seed_, stats in best]
+
+
+def export_candidates(best, directory, duration=120.0, musicxml=True, midi=True, notate=False):
+    """Regenerate each kept candidate from its seed and write it to
+    `directory` as candidate<rank>-<seed>.xml/.mid with the native writers,
+    or through music21 with `notate`. Returns the paths written."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = []
+    musics = []
+    for rank, (_, seed, _) in enumerate(best, 1):
+        m3 = movement3.generate(seed, duration)
+        m3.music.title = 'Movement 3 candidate {} ({})'.format(rank, seed)
+        if notate:
+            musics.append(m3.music)
+            continue
+        base = os.path.join(directory, 'candidate{}-{}'.format(rank, seed))
+        if musicxml:
+            musicxml_tools.write_musicxml(m3.music, base + '.xml')
+            paths.append(base + '.xml')
+        if midi:
+            midi_tools.write_midi(m3.music, base + '.mid')
+            paths.append(base + '.mid')
+    if notate:
+        paths = export_scores(musics, directory, musicxml=musicxml, midi=midi)
+    return paths
+
+
+def print_best(best):
+    print
+    print '-' * 10, 'BEST CANDIDATES', '-' * 10
+    for rank, (candidate_score, seed, stats) in enumerate(best, 1):
+        components = score_components(stats)
+        print '{}. seed {} score {:.4f} ({})'.format(
+            rank,
+            seed,
+            candidate_score,
+            ', '.join('{} {:.3f}'.format(name, components[name]) for name in sorted(components))
+        )
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-n',
+        '--candidates',
+        help='number of realizations to generate',
+        type=int,
+        default=16)
+    parser.add_argument(
+        '-k',
+        '--keep',
+        help='number of best realizations to keep and export',
+        type=int,
+        default=4)
+    parser.add_argument(
+        '-s',
+        '--seed',
+        help='make the candidates reproducible from this seed',
+        type=int)
+    parser.add_argument(
+        '-d',
+        '--duration',
+        help='length of each realization in seconds',
+        type=float,
+        default=120.0)
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='number of processes, one per CPU by default',
+        type=int)
+    parser.add_argument(
+        '-o',
+        '--output',
+        help='directory to export the kept candidates to',
+        default='notation')
+    parser.add_argument(
+        '--notate',
+        help='export through music21 instead of the native writers',
+        action='store_true')
+    args = parser.parse_args()
+
+    best = farm(args.candidates, args.keep, args.seed, args.duration, args.workers)
+    print_best(best)
+    for path in export_candidates(best, args.output, args.duration, notate=args.notate):
+        print path
@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 
 import random
-import math
+import time
+import multiprocessing
+from collections import Counter
 
 from notation_tools import Notation
-from instrument_data import instrument_data
+import music_tools
+import profiling
+from music_tools import Note, TICKS_PER_BEAT, meter_position, pitches_to_mask, can_complete_harmony
 import utils
 
 
@@ -12,150 +16,14 @@ def range16ths(start, end, step=.25):
     return [n / 4.0 for n in xrange(int(start * 4), int(end * 4), int(step * 4))]
 
 
-def meter_position(tick):
-    position_within_beat, beat = math.modf(tick)
-    beat = int(beat)
-    beat_within_bar = beat % 4
-    bar_number = beat // 4
-    return bar_number, beat_within_bar, position_within_beat
-
-
 def beats_to_seconds(beats, bpm=60):
     return beats / (bpm / 60.0)
 
 
-def pitches_to_pitchclasses(pitches):
-    pitchclasses = [p % 12 for p in pitches]
-    pitchclasses = list(set(pitchclasses))
-    pitchclasses.sort()
-    pitchclasses = tuple(pitchclasses)
-    return pitchclasses
-
-
-def get_inversions(pitchclasses):
-    inversions = []
-    for p1 in pitchclasses:
-        inversion = [(p2 - p1) % 12 for p2 in pitchclasses]
-        inversion.sort()
-        inversions.append(tuple(inversion))
-    return inversions
-
-
-def make_allowed_harmonies():
-    allowed_harmonies_1st_inversions = [
-        # Just a quick draft
-        (0, ),
-        # (0, 2),
-        # (0, 3),
-        (0, 4),
-        (0, 5),
-        (0, 4, 7),
-        (0, 3, 7),
-        (0, 5, 7),
-        (0, 3, 5),
-        (0, 2, 5),
-        # (0, 3, 6),
-        # (0, 4, 8),
-        (0, 2, 4),
-        # (0, 2, 6),
-        (0, 4, 7, 11),
-        (0, 4, 7, 10),
-        (0, 3, 7, 10),
-        (0, 5, 7, 10),
-        (0, 2, 5, 7),
-        (0, 2, 4, 7),
-        (0, 2, 3, 7),
-        (0, 3, 5, 7),
-        # (0, 3, 6, 9),
-        # (0, 2, 4, 8),
-        (0, 2, 4, 7, 11),
-        (0, 2, 4, 7, 10),
-        (0, 2, 3, 7, 10),
-        (0, 2, 4, 6, 8, 10),
-        (0, 2, 4, 5, 7, 11),
-        (0, 2, 4, 5, 7, 10),
-        (0, 2, 3, 5, 7, 10),
-    ]
-    allowed_harmonies = []
-    for harmony in allowed_harmonies_1st_inversions:
-        for root in range(12):
-            transposed_harmony = tuple([(p + root) % 12 for p in harmony])
-            allowed_harmonies.append(transposed_harmony)
-
-    # for harmony in allowed_harmonies_1st_inversions:
-    #     inversions = get_inversions(harmony)
-    #     allowed_harmonies.extend(inversions)
-    return allowed_harmonies
-
-
-allowed_harmonies = make_allowed_harmonies()
-
-
-def is_harmony_allowed(pitches):
-    return tuple(pitches_to_pitchclasses(pitches)) in allowed_harmonies
-
-
-class Tick(object):
-    def __init__(self, tick):
-        self.tick = tick
-        self.bar_number, self.beat_within_bar, self.position_within_beat = meter_position(tick)
-
-
-class Note(object):
-    def __init__(self, pitch=None, duration=0.0):
-        self.pitch = pitch
-        self.duration = duration
-
-    def __repr__(self):
-        return '<Note - pitch: {} duration: {}>'.format(self.pitch, self.duration)
-
-
-class Instrument(list):
-    def __init__(self, inst_name):
-        self.name = inst_name
-        self.abbreviation = instrument_data[self.name]['abbreviation']
-        self.range = instrument_data[self.name]['range']
-        self._make_registers()
-
+class Instrument(music_tools.Instrument):
     def __repr__(self):
         return '<full_movie.Instrument: {}>'.format(self.name)
 
-    def _make_registers(self, n_chunks=7):
-        self.lowest_note = self.range[0]
-        self.highest_note = self.range[-1]
-
-        separators = []
-        for i in range(int(n_chunks) + 1):
-            separator = i * (len(self.range) / float(n_chunks))
-            separators.append(separator)
-
-        registers = []
-        for a, b in utils.pairwise(separators):
-            chunk = [p for i, p in enumerate(self.range) if a <= i < b]
-            registers.append(chunk)
-
-        self.middle_register = registers[3]  # assuming 7 divisions
-        self.highest_register = registers[-1]
-        self.lowest_register = registers[0]
-        self.safe_register = utils.flatten(registers[1:-1])
-        self.very_safe_register = utils.flatten(registers[2:-2])
-
-    def duration(self):
-        return sum([note.duration for note in self])
-
-    def get_tick(self):
-        return Tick(self.duration())
-
-    def add_note(self, pitch=None, duration=0.0):
-        self.append(Note(pitch=pitch, duration=duration))
-
-    def get_at_tick(self, tick):
-        duration = 0
-        for note in self:
-            if duration <= tick < duration + note.duration:
-                return note
-            duration += note.duration
-
 
 class Music(object):
     def __init__(self):
@@ -175,6 +43,8 @@ class Music(object):
         self.starting_tempo_bpm = 160
         self.starting_tempo_quarter_duration = 1.0
 
+        self.fragment_stats = Counter()
+
         self._setup_parts()
 
 
@@ -198,7 +68,10 @@ class Music(object):
             result[instrument.name] = instrument.get_at_tick(tick)
         return result
 
-    def notate(self):
+    def notate(self, show=True, musicxml_path=None, midi_path=None, exporter=None):
+        """Build a music21 score of the music, then write it to
+        `musicxml_path`/`midi_path`, on `exporter`'s thread if given, and
+        open it in the notation app if `show`."""
         self.notation = Notation(
             instrument_names=self.instrument_names,
             title=self.title,
@@ -210,10 +83,14 @@ class Music(object):
 
         for instrument in self.instruments:
             notation_instrument = self.notation.instruments_by_name[instrument.name]
-            for note in instrument:
-                notation_instrument.add_note(note.pitch, note.duration)
+            notation_instrument.add_notes((note.pitch, note.duration) for note in instrument)
 
-        self.notation.show()
+        if exporter:
+            exporter.export(self.notation, musicxml_path, midi_path)
+        elif musicxml_path or midi_path:
+            self.notation.export(musicxml_path, midi_path)
+        if show:
+            self.notation.show()
 
     def september_song(self):
         notes = [
@@ -368,26 +245,47 @@ class Music(object):
     #     for instrument in entrance_order:
     #         instrument.pace = random.choice([.5, 1, 1, 2])
 
-    def check_fragment(self, start=0, end=None):
+    def find_harmony_violation(self, start=0, end=None, n_more_voices=0, instruments=None):
+        """Find the first disallowed harmony between `start` and `end`.
+
+        Harmonies only change where some note starts or stops, so only those
+        points are checked, on the integer tick grid, which is exact for any
+        subdivision. Returns (tick, pitches) for the first violation, or None.
+
+        While a fragment is still being built, `n_more_voices` says how many
+        single-pitch parts are yet to be added; only harmonies that those
+        parts could not turn into allowed ones count as violations.
+
+        """
+        if instruments is None:
+            instruments = self.instruments
         if end is None:
             end = self.duration()
+        start_ticks = start * TICKS_PER_BEAT
+        end_ticks = end * TICKS_PER_BEAT
 
-        allowed = []
-        for tick in xrange(int(start * 12), int(end * 12)):
-            tick = tick / 12.0
-            notes = self.get_at_tick(tick)
+        for tick, change_end, sounding in music_tools.sweep_ticks(instruments):
+            if change_end <= start_ticks:
+                continue
+            if tick >= end_ticks:
+                break
 
             all_pitches = []
-            for name in notes:
-                pitches = notes[name].pitch
-                if pitches is not 'rest' and pitches is not None:
+            for note in sounding:
+                if note is None:
+                    continue
+                pitches = note.pitch
+                if pitches != 'rest' and pitches is not None:
                     if isinstance(pitches, list):
                         all_pitches.extend(pitches)
                     else:
                         all_pitches.append(pitches)
 
-            allowed.append(is_harmony_allowed(all_pitches))
-        return all(allowed)
+            if not can_complete_harmony(pitches_to_mask(all_pitches), n_more_voices):
+                return max(music_tools.ticks_to_beats(tick), start), all_pitches
+
+    def check_fragment(self, start=0, end=None):
+        return self.find_harmony_violation(start, end) is None
 
     def make_lick(self, instrument, duration=4.0, scale=[0, 2, 4, 5, 7, 9, 11]):
         if random.random() < .5:
@@ -405,9 +303,7 @@ class Music(object):
             n_attacks = 2
 
         if random.random() < .2:
-            n_attacks_options = range(1, int(lick_total_duration * 2))
-            n_attacks_weights = range(1, len(n_attacks_options) + 1)
-            n_attacks = utils.weighted_choice(n_attacks_options, n_attacks_weights)
+            n_attacks = n_attacks_sampler(int(lick_total_duration * 2)).choice()
 
 
         # if random.random() < .2:
@@ -471,7 +367,25 @@ class Music(object):
             instrument = self.grid[fragment_instrument.name]
             instrument.extend(fragment_instrument)
 
-    def make_fragment(self, duration=4.0, scale=[0, 2, 4, 5, 7, 9, 11], n_instruments=8):
+    def parts(self):
+        """The notes of each instrument as plain (pitch, duration) tuples,
+        cheap to send between processes."""
+        return [(i.name, [(note.pitch, note.duration) for note in i]) for i in self.instruments]
+
+    def extend_with_parts(self, parts):
+        for name, notes in parts:
+            self.grid[name].extend([Note(pitch, duration) for pitch, duration in notes])
+
+    def make_fragment(self, duration=4.0, scale=[0, 2, 4, 5, 7, 9, 11], n_instruments=8, prune=False):
+        """Make a fragment with `n_instruments` playing licks.
+
+        With `prune`, the harmony is checked as each lick is added, and None
+        is returned as soon as the licks placed so far can't be completed
+        into allowed harmonies. Only fragments that would fail the full
+        check are given up on, so accepted fragments are distributed as if
+        every one had been built and checked.
+
+        """
         fragment = Music()
 
 
@@ -479,9 +393,19 @@ class Music(object):
 
         instruments = random.sample(fragment.instruments, n_instruments)
 
-        for instrument in instruments:
+        for n_placed, instrument in enumerate(instruments, 1):
             self.make_lick(instrument, duration=duration, scale=scale)
 
+            if prune:
+                n_more_voices = n_instruments - n_placed
+                violation = fragment.find_harmony_violation(
+                    n_more_voices=n_more_voices,
+                    instruments=instruments[:n_placed]
+                )
+                if violation is not None:
+                    self.fragment_stats['pruned_licks'] += n_more_voices
+                    return
+
         resting_instruments = [i for i in fragment.instruments if i not in instruments]
 
         # Put rests in instruments that aren't playing
@@ -490,68 +414,285 @@ class Music(object):
 
         return fragment
 
-    def make_fragments(self):
+    def plan_fragment(self, scale, rng=random):
+        """Roll the key, duration and whether to add an instrument for the
+        next fragment attempt. These don't depend on which attempts were
+        accepted."""
+        if rng.random() < .15:
+            # Change keys
+            switch = rng.random()
+            if switch < .6:
+                # Go up a fifth
+                scale = [(p + 7) % 12 for p in scale]
+            elif switch < .9:
+                # Go down a fifth
+                scale = [(p - 7) % 12 for p in scale]
+            elif switch < .95:
+                # Go up a whole step
+                scale = [(p + 2) % 12 for p in scale]
+            else:
+                # Go down a whole step
+                scale = [(p - 2) % 12 for p in scale]
+
+
+        # scale = [0, 2, 4, 7, 9]
+        # scale = range(12)
+        # for _ in range(random.randint(0, 5)):
+        #     pc = random.choice(scale)
+        #     scale.remove(pc)
+
+        duration = rng.choice([3, 3, 3, 3, 4, 4, 4, 4, 4, 4, 4, 4, 5, 6, 6, 6, 7, 8, 8, 8])
+
+        add_instrument = rng.random() < .3
+
+        return scale, duration, add_instrument
+
+    def accept_fragment(self, parts, duration):
+        print
+        print 'Whoa!!!!'
+        self.extend_with_parts(parts)
+
+        self.fragment_stats['accepted'] += 1
+        self.fragment_stats['accepted_beats'] += duration
+
+    def make_fragments(self, n_attempts=2500, seed=None, n_workers=1, chunk_size=8):
+        """Try `n_attempts` random fragments, keeping the ones whose
+        harmonies are all allowed.
+
+        Without a `seed` everything is drawn from the global random module.
+        With one, the key, duration and instrument count of every attempt
+        come from a stream seeded by `seed`, and each fragment is built from
+        its own seed derived from `seed` and the attempt number. The output
+        then only depends on `seed`, and `n_workers` > 1 builds fragments in
+        a process pool. See `_make_fragments_seeded`.
+
+        """
+        start_time = time.time()
+
+        if seed is None and n_workers > 1:
+            seed = random.getrandbits(32)
+
+        if seed is None:
+            self._make_fragments_unseeded(n_attempts)
+        else:
+            self._make_fragments_seeded(n_attempts, seed, n_workers, chunk_size)
+
+        self.fragment_stats['seconds'] += time.time() - start_time
+        self.print_fragment_stats()
+
+    def _make_fragments_unseeded(self, n_attempts):
         scale = [0, 2, 4, 5, 7, 9, 11]
 
         n_instruments = 1
 
-        for count in range(2500):
-
-            if random.random() < .15:
-                # Change keys
-                switch = random.random()
-                if switch < .6:
-                    # Go up a fifth
-                    scale = [(p + 7) % 12 for p in scale]
-                elif switch < .9:
-                    # Go down a fifth
-                    scale = [(p - 7) % 12 for p in scale]
-                elif switch < .95:
-                    # Go up a whole step
-                    scale = [(p + 2) % 12 for p in scale]
-                else:
-                    # Go down a whole step
-                    scale = [(p - 2) % 12 for p in scale]
-
+        for count in range(n_attempts):
+            scale, duration, add_instrument = self.plan_fragment(scale)
 
-            # scale = [0, 2, 4, 7, 9]
-            # scale = range(12)
-            # for _ in range(random.randint(0, 5)):
-            #     pc = random.choice(scale)
-            #     scale.remove(pc)
+            n_instruments_candidate = n_instruments
+            if add_instrument:
+                n_instruments_candidate = next_n_instruments(n_instruments)
+
+            self.fragment_stats['attempts'] += 1
+            fragment = self.make_fragment(
+                duration=duration,
+                scale=scale,
+                n_instruments=n_instruments_candidate,
+                prune=True
+            )
+            print count,
 
-            duration = random.choice([3, 3, 3, 3, 4, 4, 4, 4, 4, 4, 4, 4, 5, 6, 6, 6, 7, 8, 8, 8])
+            if fragment is not None:
+                self.accept_fragment(fragment.parts(), duration)
+                n_instruments = n_instruments_candidate
 
+    def _make_fragments_seeded(self, n_attempts, seed, n_workers, chunk_size):
+        """Build attempts in batches, speculatively, and accept them in order.
 
-            n_instruments_candidate = n_instruments
+        The only state carried from one attempt to the next that depends on
+        acceptance is the number of instruments. A batch is built assuming
+        it stays the same; when an accepted fragment changes it, the rest of
+        the batch is thrown away and rebuilt. So the result is the same as
+        building one attempt at a time, whatever the number of workers.
 
-            if random.random() < .3:
-                if n_instruments_candidate == 7:
-                    n_instruments_candidate = 1
-                else:
-                    n_instruments_candidate += 1
+        """
+        rng = random.Random(seed)
+        scale = [0, 2, 4, 5, 7, 9, 11]
+        plans = []
+        for attempt in range(n_attempts):
+            scale, duration, add_instrument = self.plan_fragment(scale, rng)
+            plans.append((scale, duration, add_instrument, utils.derive_seed(None, seed, attempt)))
 
-            fragment = self.make_fragment(duration=duration, scale=scale, n_instruments=n_instruments_candidate)
-            print count,
+        pool = None
+        if n_workers > 1:
+            pool = multiprocessing.Pool(n_workers, initializer=_init_fragment_worker)
+        else:
+            random_state = random.getstate()
 
-            if fragment.check_fragment():
-                print
-                print 'Whoa!!!!'
-                self.extend_with_fragment(fragment)
-                n_instruments = n_instruments_candidate
+        n_instruments = 1
+        attempt = 0
+        try:
+            while attempt < n_attempts:
+                batch = []
+                for i in range(attempt, min(attempt + n_workers * chunk_size, n_attempts)):
+                    scale, duration, add_instrument, attempt_seed = plans[i]
+                    n_instruments_candidate = n_instruments
+                    if add_instrument:
+                        n_instruments_candidate = next_n_instruments(n_instruments)
+                    batch.append((i, scale, duration, n_instruments_candidate, attempt_seed))
+
+                chunks = list(utils.group(batch, chunk_size))
+                if pool:
+                    results = pool.map(_build_fragments, chunks)
+                else:
+                    results = map(_build_fragments, chunks)
+
+                for task, result in zip(batch, utils.flatten(results)):
+                    i, _, duration, n_instruments_candidate, _ = task
+                    fragment, n_pruned_licks = result
+                    attempt = i + 1
+                    self.fragment_stats['attempts'] += 1
+                    self.fragment_stats['pruned_licks'] += n_pruned_licks
+                    print i,
+
+                    if fragment is not None:
+                        self.accept_fragment(fragment, duration)
+                        if n_instruments_candidate != n_instruments:
+                            n_instruments = n_instruments_candidate
+                            self.fragment_stats['discarded_speculative'] += len(batch) - (i + 1 - batch[0][0])
+                            break
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            else:
+                random.setstate(random_state)
+
+    def print_fragment_stats(self):
+        stats = self.fragment_stats
+        print
+        print '-' * 10, 'FRAGMENT STATS', '-' * 10
+        print 'attempts', stats['attempts']
+        print 'accepted', stats['accepted']
+        print 'pruned licks', stats['pruned_licks']
+        if stats['discarded_speculative']:
+            print 'discarded speculative attempts', stats['discarded_speculative']
+        print 'seconds', round(stats['seconds'], 3)
+        if stats['accepted_beats']:
+            print 'seconds per accepted beat', round(stats['seconds'] / stats['accepted_beats'], 5)
+        if profiling.enabled:
+            profiling.print_report()
+
+
+profiling.register(
+    Music,
+    'make_fragments',
+    'make_fragment',
+    'make_lick',
+    'find_harmony_violation',
+    'check_fragment',
+    'notate'
+)
+
+
+_n_attacks_samplers = {}
+
+
+def n_attacks_sampler(n_half_beats):
+    """Favor more attacks in a lick, up to one every half beat."""
+    sampler = _n_attacks_samplers.get(n_half_beats)
+    if sampler is None:
+        n_attacks_options = range(1, n_half_beats)
+        n_attacks_weights = range(1, len(n_attacks_options) + 1)
+        sampler = utils.WeightedSampler(n_attacks_options, n_attacks_weights)
+        _n_attacks_samplers[n_half_beats] = sampler
+    return sampler
+
+
+def next_n_instruments(n_instruments):
+    if n_instruments == 7:
+        return 1
+    return n_instruments + 1
+
+
+# Each pool worker keeps one Music around to build fragments with, so tasks
+# don't pay for imports or setup
+_worker_music = None
+
+
+def _init_fragment_worker():
+    global _worker_music
+    _worker_music = Music()
+
+
+def _build_fragments(attempts):
+    """Build and check a chunk of seeded attempts.
+
+    Returns (parts, n_pruned_licks) for each attempt, where parts is None
+    if the fragment was rejected.
+
+    """
+    if _worker_music is None:
+        _init_fragment_worker()
+    stats = _worker_music.fragment_stats
+
+    results = []
+    for _, scale, duration, n_instruments, attempt_seed in attempts:
+        random.seed(attempt_seed)
+        n_pruned_licks = stats['pruned_licks']
+        fragment = _worker_music.make_fragment(
+            duration=duration,
+            scale=scale,
+            n_instruments=n_instruments,
+            prune=True
+        )
+        if fragment is not None:
+            fragment = fragment.parts()
+        results.append((fragment, stats['pruned_licks'] - n_pruned_licks))
+    return results
 
 
+def main(seed=None, n_workers=1, output=None, profile=False):
+    if profile:
+        profiling.enable(profile=True, trace_memory=True)
 
-def main():
     music = Music()
 
-    music.make_fragments()
+    music.make_fragments(seed=seed, n_workers=n_workers)
     # music.big_chord()
     # music.make_random_notes()
     # music.september_song()
 
-    music.notate()
+    if output:
+        music.notate(show=False, musicxml_path=output + '.xml', midi_path=output + '.mid')
+    else:
+        music.notate()
+
+    if profile:
+        profiling.print_report()
 
 
 if __name__ == '__main__':
-    main()
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-s',
+        '--seed',
+        help='make the output reproducible from this seed',
+        type=int)
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='number of processes to build fragments with',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '-o',
+        '--output',
+        help='notate to OUTPUT.xml and OUTPUT.mid instead of opening a notation app')
+    parser.add_argument(
+        '-p',
+        '--profile',
+        help='time each phase and run cProfile; phases run by workers aren\'t counted',
+        action="store_true")
+    args = parser.parse_args()
+    main(seed=args.seed, n_workers=args.workers, output=args.output, profile=args.profile)
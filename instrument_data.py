@@ -1,34 +1,43 @@
+# midi_program is the General MIDI program number, counting from 0
 instrument_data = {
     'violin': {
         'range': range(55, 96),
         'abbreviation': 'vln',
+        'midi_program': 40,
     },
     'flute': {
         'range': range(60, 97),
         'abbreviation': 'f',
+        'midi_program': 73,
     },
     'oboe': {
         'range': range(59, 87),
         'abbreviation': 'ob',
+        'midi_program': 68,
     },
     'clarinet': {
         'range': range(50, 90),
         'abbreviation': 'cl',
+        'midi_program': 71,
     },
     'alto_saxophone': {
         'range': range(49, 81),
         'abbreviation': 'sx',
+        'midi_program': 65,
     },
     'trumpet': {
         'range': range(52, 83),
         'abbreviation': 'tpt',
+        'midi_program': 56,
     },
     'bass': {
         'range': range(28, 61),
         'abbreviation': 'b',
+        'midi_program': 32,
     },
     'percussion': {
         'range': None,
         'abbreviation': 'perc',
+        'midi_program': 0,
     },
 }
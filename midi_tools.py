@@ -0,0 +1,117 @@
+"""Write a Standard MIDI File straight from a music_tools.Music.
+
+Each part is walked once into its own track, with a program change from
+instrument_data. Track 0 has the title, tempo and time signature. No
+music21 or other dependencies.
+
+"""
+import struct
+
+from music_tools import TICKS_PER_BEAT, beats_to_ticks
+
+
+# Ticks per quarter note. Music durations are in quarter notes.
+DIVISION = TICKS_PER_BEAT
+
+VELOCITY = 80
+
+# General MIDI puts percussion on channel 10, counting from 1
+PERCUSSION_CHANNEL = 9
+
+END_OF_TRACK = b'\x00\xff\x2f\x00'
+
+
+def variable_length(value):
+    """Encode an int as a MIDI variable-length quantity."""
+    encoded = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        encoded.insert(0, (value & 0x7f) | 0x80)
+        value >>= 7
+    return encoded
+
+
+def _meta_event(meta_type, data):
+    event = bytearray([0x00, 0xff, meta_type])
+    event += variable_length(len(data))
+    event += data
+    return event
+
+
+def _chunk(chunk_type, data):
+    return chunk_type + struct.pack('>I', len(data)) + bytes(data)
+
+
+def _conductor_track(music):
+    track = bytearray()
+    track += _meta_event(0x03, music.title.encode('utf-8'))
+
+    microseconds_per_quarter = int(round(60000000.0 / (music.starting_tempo_bpm * music.starting_tempo_quarter_duration)))
+    track += _meta_event(0x51, struct.pack('>I', microseconds_per_quarter)[1:])
+
+    if music.time_signature:
+        beats, beat_type = [int(n) for n in music.time_signature.split('/')]
+        log_beat_type = beat_type.bit_length() - 1
+        track += _meta_event(0x58, bytearray([beats, log_beat_type, 24, 8]))
+
+    track += END_OF_TRACK
+    return track
+
+
+def _instrument_track(instrument, channel):
+    track = bytearray()
+    track += _meta_event(0x03, instrument.name.encode('utf-8'))
+    track += bytearray([0x00, 0xc0 | channel, instrument.midi_program])
+
+    note_on = 0x90 | channel
+    note_off = 0x80 | channel
+    delta = 0
+    for note in instrument:
+        ticks = beats_to_ticks(note.duration)
+        pitch = note.pitch
+        if not ticks or pitch is None or pitch == 'rest' or pitch == []:
+            delta += ticks
+            continue
+        pitches = pitch if isinstance(pitch, list) else [pitch]
+
+        for p in pitches:
+            track += variable_length(delta)
+            track += bytearray([note_on, p, VELOCITY])
+            delta = 0
+        delta = ticks
+        for p in pitches:
+            track += variable_length(delta)
+            track += bytearray([note_off, p, 0])
+            delta = 0
+
+    track += variable_length(delta)
+    track += END_OF_TRACK[1:]
+    return track
+
+
+def _channels(instruments):
+    """A channel for each instrument, skipping the percussion channel
+    except for percussion."""
+    channels = []
+    available = [c for c in range(16) if c != PERCUSSION_CHANNEL]
+    for instrument in instruments:
+        if instrument.name == 'percussion':
+            channels.append(PERCUSSION_CHANNEL)
+        else:
+            channels.append(available[0])
+            available.append(available.pop(0))
+    return channels
+
+
+def write_midi(music, destination):
+    """Write `music` as a format 1 Standard MIDI File to `destination`, a
+    path or a file-like object opened in binary mode."""
+    if isinstance(destination, basestring):
+        with open(destination, 'wb') as f:
+            return write_midi(music, f)
+    write = destination.write
+
+    write(_chunk(b'MThd', struct.pack('>HHH', 1, len(music.instruments) + 1, DIVISION)))
+    write(_chunk(b'MTrk', _conductor_track(music)))
+    for instrument, channel in zip(music.instruments, _channels(music.instruments)):
+        write(_chunk(b'MTrk', _instrument_track(instrument, channel)))
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""Monte Carlo statistics for tuning Movement3.
+
+Runs many short seeded generations across a process pool. Each worker
+folds a chunk of runs into an Aggregate and sends that back, never the
+music or the runs' own stats, and the chunks are merged pairwise as they
+finish, like a binary counter, so memory stays the same however many
+runs there are. A progress line is printed as each chunk comes in.
+
+Each run gives one observation per metric: the share of its harmonies of
+each chord type, the share of its phrases of each length in beats, its
+mean phrase length and its fallback rate, how often a cluster had to
+repeat its pitch because nothing else was allowed. The report is the
+mean of each over the runs with a confidence interval.
+
+"""
+import math
+import random
+import multiprocessing
+from collections import Counter
+
+import movement3
+from utils import derive_seed
+
+
+# Normal quantile for a 95% interval
+Z = 1.96
+
+
+class Aggregate(object):
+    """Mergeable sums over runs of Movement3 stats.
+
+    Metrics are keyed by (family, value), e.g. ('harmony', (0, 1)) or
+    ('phrase', 8.0). A run without a value still counts as a 0 for every
+    metric in a family it has, so only sums, sums of squares and a run
+    count per family are needed.
+
+    """
+    def __init__(self):
+        self.runs = 0
+        # Pooled counts over all runs
+        self.totals = Counter()
+        # Runs that had each family
+        self.observed = Counter()
+        self.sums = Counter()
+        self.squares = Counter()
+
+    def _observe(self, family, values):
+        self.observed[family] += 1
+        for value, x in values.iteritems():
+            key = (family, value)
+            self.sums[key] += x
+            self.squares[key] += x * x
+
+    def add_run(self, stats):
+        """Add one run's stats, from Movement3.export_stats()."""
+        self.runs += 1
+
+        harmonies = stats['harmonies']
+        n_harmonies = float(sum(harmonies.values()))
+        for harmony, count in harmonies.iteritems():
+            self.totals[('harmony', harmony)] += count
+        if n_harmonies:
+            self._observe('harmony', dict((h, c / n_harmonies) for h, c in harmonies.iteritems()))
+
+        phrases = stats['beats_since_last_rest']
+        n_phrases = float(sum(phrases.values()))
+        for beats, count in phrases.iteritems():
+            self.totals[('phrase', beats)] += count
+        if n_phrases:
+            self._observe('phrase', dict((b, c / n_phrases) for b, c in phrases.iteritems()))
+            mean_length = sum(b * c for b, c in phrases.iteritems()) / n_phrases
+            self._observe('phrase_mean', {None: mean_length})
+
+        allowed = stats['allow_repeated_pitch']
+        not_allowed = stats['dont_allow_repeated_pitch']
+        self.totals[('fallback', True)] += allowed
+        self.totals[('fallback', False)] += not_allowed
+        if allowed + not_allowed:
+            self._observe('fallback', {None: allowed / float(allowed + not_allowed)})
+
+    def merge(self, other):
+        """Add another Aggregate's runs to this one, in place."""
+        self.runs += other.runs
+        self.totals.update(other.totals)
+        self.observed.update(other.observed)
+        self.sums.update(other.sums)
+        self.squares.update(other.squares)
+        return self
+
+    def copy(self):
+        return Aggregate().merge(self)
+
+    def values(self, family):
+        return sorted(value for f, value in self.sums if f == family)
+
+    def interval(self, family, value=None):
+        """(mean, half width of the confidence interval) of a metric over
+        the runs that had its family."""
+        n = self.observed[family]
+        if not n:
+            return None, None
+        key = (family, value)
+        mean = self.sums[key] / n
+        if n < 2:
+            return mean, None
+        variance = max(0.0, (self.squares[key] - n * mean * mean) / (n - 1))
+        return mean, Z * math.sqrt(variance / n)
+
+
+def _run_chunk(job):
+    seeds, duration = job
+    aggregate = Aggregate()
+    for seed in seeds:
+        aggregate.add_run(movement3.generate(seed, duration).export_stats())
+    return aggregate
+
+
+def _collapse(stack):
+    """One Aggregate from a stack of partials, leaving the stack alone."""
+    total = Aggregate()
+    for _, partial in stack:
+        total.merge(partial)
+    return total
+
+
+def simulate(n_runs=1000, seed=None, duration=30.0, n_workers=None, chunk_size=20, progress=None):
+    """Generate `n_runs` Movement3s of `duration` seconds and return the
+    Aggregate of their stats.
+
+    Run seeds come from `seed` and the run number. `progress`, if given, is
+    called with the Aggregate so far each time a chunk finishes.
+    `n_workers` defaults to one per CPU.
+
+    """
+    if seed is None:
+        seed = random.getrandbits(32)
+    jobs = (
+        ([derive_seed('montecarlo', seed, n) for n in xrange(start, min(start + chunk_size, n_runs))], duration)
+        for start in xrange(0, n_runs, chunk_size)
+    )
+
+    pool = None
+    if n_workers != 1:
+        pool = multiprocessing.Pool(n_workers)
+        partials = pool.imap_unordered(_run_chunk, jobs)
+    else:
+        partials = (_run_chunk(job) for job in jobs)
+
+    # (number of chunks merged, Aggregate), merged whenever the top two are
+    # the same size, so there are never more than log2(chunks) of them
+    stack = []
+    try:
+        for partial in partials:
+            size = 1
+            while stack and stack[-1][0] == size:
+                size += stack[-1][0]
+                partial = stack.pop()[1].merge(partial)
+            stack.append((size, partial))
+            if progress:
+                progress(_collapse(stack))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    return _collapse(stack)
+
+
+def _format_interval(mean, half_width, scale=1.0, decimals=3):
+    if mean is None:
+        return '-'
+    if half_width is None:
+        return '{:.{}f}'.format(mean * scale, decimals)
+    return '{:.{}f} +/- {:.{}f}'.format(mean * scale, decimals, half_width * scale, decimals)
+
+
+def print_progress(aggregate):
+    print 'runs {:>6}  fallback rate {:<20} mean phrase {}'.format(
+        aggregate.runs,
+        _format_interval(*aggregate.interval('fallback')),
+        _format_interval(*aggregate.interval('phrase_mean'), decimals=2)
+    )
+
+
+def print_report(aggregate, n_harmonies=20):
+    print
+    print '-' * 10, 'MONTE CARLO: {} RUNS'.format(aggregate.runs), '-' * 10
+    print 'fallback rate', _format_interval(*aggregate.interval('fallback'))
+    print 'mean phrase length', _format_interval(*aggregate.interval('phrase_mean'), decimals=2)
+
+    print
+    print '{:<16} {:>8} {:>22} {:>10}'.format('harmony', 'target %', '% of harmonies', 'count')
+    target_total = sum(movement3.ALLOWED_HARMONIES.values())
+    harmonies = aggregate.values('harmony')
+    harmonies.sort(key=lambda h: aggregate.interval('harmony', h)[0], reverse=True)
+    for harmony in harmonies[:n_harmonies]:
+        print '{:<16} {:>8.2f} {:>22} {:>10}'.format(
+            harmony,
+            movement3.ALLOWED_HARMONIES.get(harmony, 0.0) / target_total * 100,
+            _format_interval(*aggregate.interval('harmony', harmony), scale=100, decimals=2),
+            aggregate.totals[('harmony', harmony)]
+        )
+
+    print
+    print '{:<16} {:>22} {:>10}'.format('phrase beats', '% of phrases', 'count')
+    for beats in aggregate.values('phrase'):
+        print '{:<16} {:>22} {:>10}'.format(
+            beats,
+            _format_interval(*aggregate.interval('phrase', beats), scale=100, decimals=2),
+            aggregate.totals[('phrase', beats)]
+        )
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-n',
+        '--runs',
+        help='number of generations',
+        type=int,
+        default=1000)
+    parser.add_argument(
+        '-s',
+        '--seed',
+        help='make the runs reproducible from this seed',
+        type=int)
+    parser.add_argument(
+        '-d',
+        '--duration',
+        help='length of each generation in seconds',
+        type=float,
+        default=30.0)
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='number of processes, one per CPU by default',
+        type=int)
+    parser.add_argument(
+        '-c',
+        '--chunk',
+        help='runs per task sent to a worker',
+        type=int,
+        default=20)
+    parser.add_argument(
+        '-q',
+        '--quiet',
+        help='don\'t print progress as chunks finish',
+        action='store_true')
+    args = parser.parse_args()
+
+    aggregate = simulate(
+        args.runs,
+        args.seed,
+        args.duration,
+        args.workers,
+        args.chunk,
+        progress=None if args.quiet else print_progress
+    )
+    print_report(aggregate)
@@ -1,10 +1,15 @@
 #!/usr/bin/env python
 
 import random
+import pickle
 from collections import Counter
 
-from music_tools import Music, pitches_to_chord_type
-from utils import weighted_choice
+from music_tools import Music, pitches_to_interned_chord_type
+from utils import weighted_choice, WeightedSampler
+import musicxml_tools
+import midi_tools
+import snapshot_tools
+import profiling
 
 
 ALLOWED_HARMONIES = {
@@ -97,8 +102,72 @@ BLUES_PROGRESSION = [
 SCALE = (0, 2, 3, 4, 5, 7, 9, 11)
 
 
+# Bass note durations, by beat within the bar
+BASS_DURATIONS = {
+    0: WeightedSampler([1,  2,  3, 4, 5, 6, 7, 8],
+                       [35, 24, 2, 6, 1, 1, 1, 2]),
+    1: WeightedSampler([1,  2,  3,  4, 5, 6, 7],
+                       [35, 12, 16, 1, 1, 1, 3]),
+    2: WeightedSampler([1,  2,  4, 6],
+                       [24, 24, 1, 2]),
+    3: WeightedSampler([1,  2, 5],
+                       [40, 2, 5]),
+}
+
+# Defaults for the constants a Movement3 can be given in `params`.
+# bass_durations is a list, by beat within the bar, of (durations, weights)
+# and replaces BASS_DURATIONS.
+DEFAULT_PARAMS = {
+    # How much the closeness of a new cluster pitch to the previous one
+    # counts against the weight of the harmony it makes
+    'distance_weight': 1.0,
+    'harmony_weight': .33,
+    # Factors for new cluster pitches in the current blues chord, and above
+    # the previous pitch
+    'blues_weight': 3,
+    'ascent_weight': 1.5,
+    'bass_durations': None,
+}
+
+# Rests between cluster phrases, and the longer ones used now and then
+# after a long stretch without a long rest
+CLUSTER_RESTS = WeightedSampler([1,  2],
+                                [16, 1])
+CLUSTER_LONG_RESTS = WeightedSampler([4,  5,  6, 7],
+                                     [16, 12, 2, 1])
+
+
+# Bump when what a checkpoint holds, or how generation carries on from
+# one, changes
+CHECKPOINT_VERSION = 1
+
+# Transition tables and bass duration samplers shared by every Movement3 in
+# the process, keyed by everything they depend on, so the farm, Monte Carlo
+# and sweeps don't rebuild them for each realization
+_transition_tables = {}
+_bass_duration_samplers = {}
+
+
+def _get_bass_duration_samplers(tables):
+    key = tuple((tuple(durations), tuple(weights)) for durations, weights in tables)
+    samplers = _bass_duration_samplers.get(key)
+    if samplers is None:
+        samplers = _bass_duration_samplers[key] = [WeightedSampler(*table) for table in tables]
+    return samplers
+
+
 class Movement3(object):
-    def __init__(self):
+    def __init__(self, duration=120.0, verbose=True, params=None):
+        self.setup(params)
+        self.first()
+        self.extend(duration, verbose)
+
+    def setup(self, params=None):
+        self.params = dict(DEFAULT_PARAMS, **(params or {}))
+        self.bass_durations = BASS_DURATIONS
+        if self.params['bass_durations']:
+            self.bass_durations = _get_bass_duration_samplers(self.params['bass_durations'])
+
         self.stats = self.init_stats()
         m = self.music = Music(instrument_names=(
                 'violin',
@@ -119,19 +188,97 @@ class Movement3(object):
         cluster_lowest_pitch = 70
         for i in self.clusters:
             i.cluster_range = [p for p in i.range if p >= cluster_lowest_pitch]
+        self.clear_transition_tables()
 
-        self.first()
-        self.go(120.0)
+    def extend(self, duration, verbose=True):
+        """Carry on generating until the music is `duration` seconds long."""
+        self.go(duration)
         self.stats['duration'] = self.music.duration_seconds()
-        self.print_stats()
-
-    def notate(self):
-        self.music.notate()
+        if verbose:
+            self.print_stats()
+
+    def save_checkpoint(self, destination):
+        """Save everything needed to carry on generating exactly where this
+        left off, including the state of `random`, to a path or a file-like
+        object opened in binary mode."""
+        if isinstance(destination, basestring):
+            with open(destination, 'wb') as f:
+                return self.save_checkpoint(f)
+        checkpoint = {
+            'version': CHECKPOINT_VERSION,
+            'params': self.params,
+            'stats': self.export_stats(),
+            'parts': [
+                (i.name, [(note.pitch, note.duration) for note in i], getattr(i, 'cluster_range', None))
+                for i in self.music.instruments
+            ],
+            'random_state': random.getstate(),
+        }
+        pickle.dump(checkpoint, destination, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def resume(cls, source, duration=None, verbose=True):
+        """A Movement3 restored from a checkpoint saved with save_checkpoint,
+        then, given a longer `duration`, extended to it. The result is the
+        same as generating the longer piece from the start.
+
+        Restores the state of `random`.
+
+        """
+        if isinstance(source, basestring):
+            with open(source, 'rb') as f:
+                return cls.resume(f, duration, verbose)
+        checkpoint = pickle.load(source)
+        if checkpoint.get('version') != CHECKPOINT_VERSION:
+            raise ValueError('Unsupported checkpoint version {}, expected {}'.format(
+                checkpoint.get('version'), CHECKPOINT_VERSION))
+
+        m3 = cls.__new__(cls)
+        m3.setup(checkpoint['params'])
+
+        m3.stats = checkpoint['stats']
+
+        for name, notes, cluster_range in checkpoint['parts']:
+            instrument = m3.music.grid[name]
+            for pitch, note_duration in notes:
+                instrument.add_note(pitch=pitch, duration=note_duration)
+            if cluster_range is not None:
+                instrument.cluster_range = cluster_range
+
+        random.setstate(checkpoint['random_state'])
+        m3.extend(duration or 0.0, verbose)
+        return m3
+
+    def notate(self, show=True, musicxml_path=None, midi_path=None, exporter=None):
+        self.music.notate(show, musicxml_path, midi_path, exporter)
+
+    def write_musicxml(self, destination):
+        musicxml_tools.write_musicxml(self.music, destination)
+
+    def write_midi(self, destination):
+        midi_tools.write_midi(self.music, destination)
+
+    def write_snapshot(self, destination):
+        snapshot_tools.write_snapshot(self.music, destination)
 
     def init_stats(self):
         stats = Counter()
         stats['beats_since_last_rest'] = Counter()
+        # Keyed by chord type, see music_tools.pitches_to_chord_type
         stats['harmonies'] = Counter()
+        stats['bass_durations'] = Counter()
+        return stats
+
+    def harmony_stats(self):
+        return Counter(self.stats['harmonies'])
+
+    def export_stats(self):
+        """A copy of the stats that doesn't share the nested Counters, safe
+        to keep, pickle or send to another process."""
+        stats = Counter(self.stats)
+        stats['beats_since_last_rest'] = Counter(self.stats['beats_since_last_rest'])
+        stats['bass_durations'] = Counter(self.stats['bass_durations'])
+        stats['harmonies'] = self.harmony_stats()
         return stats
 
     def print_stats(self):
@@ -142,6 +289,8 @@ class Movement3(object):
         print
         for k in sorted(self.stats['beats_since_last_rest'].keys()):
             print '{:<5}: {}'.format(k, self.stats['beats_since_last_rest'][k])
+        if profiling.enabled:
+            profiling.print_report()
 
     def print_columns(self):
         print
@@ -202,14 +351,12 @@ class Movement3(object):
             self.stats['beats_since_last_rest'][changing.beats_since_last_rest()] += 1
 
             # Add a rest before the next note
-            rest_duration_options = [1,  2]
-            rest_duration_weights = [16, 1]
+            rest_durations = CLUSTER_RESTS
             if changing.beats_since_last_rest(rest_duration=4) > 40:
                 if random.random() < .5:
-                    rest_duration_options = [4,  5,  6, 7]
-                    rest_duration_weights = [16, 12, 2, 1]
+                    rest_durations = CLUSTER_LONG_RESTS
 
-            rest_duration = weighted_choice(rest_duration_options, rest_duration_weights)
+            rest_duration = rest_durations.choice()
 
             total_event_duration += rest_duration
             changing.add_note(pitch='rest', duration=rest_duration)
@@ -222,7 +369,7 @@ class Movement3(object):
         for i in not_changing:
             i[-1].duration += total_event_duration
 
-        harmony = pitches_to_chord_type([i[-1].pitch for i in self.clusters])
+        harmony = pitches_to_interned_chord_type([i[-1].pitch for i in self.clusters])
         self.stats['harmonies'][harmony] += 1
 
     def clusters_get_revealed_harmony(self, not_changing):
@@ -253,7 +400,33 @@ class Movement3(object):
         not_changing = [w for w in self.clusters if w is not changing]
         return changing, not_changing
 
-    def clusters_pick_new_pitch(self, changing, not_changing, allow_repeated_pitch=False):
+    def clusters_candidates(self, changing, holdovers):
+        """Pitches in `changing`'s cluster range that make an allowed
+        harmony with the two sorted `holdovers`, each with the weight of
+        that harmony.
+
+        Only depends on the holdovers, so each pair is worked out once.
+
+        """
+        key = (changing.name, holdovers[0], holdovers[1])
+        candidates = self._cluster_candidates.get(key)
+        if candidates is None:
+            candidates = []
+            for pitch_option in changing.cluster_range:
+                harmony = holdovers + [pitch_option]
+                harmony.sort()
+                harmony = [ps - harmony[0] for ps in harmony]
+
+                harmony = list(set(harmony))
+                harmony.sort()
+                harmony = tuple(harmony)
+
+                if harmony in ALLOWED_HARMONIES:
+                    candidates.append((pitch_option, ALLOWED_HARMONIES[harmony]))
+            self._cluster_candidates[key] = candidates
+        return candidates
+
+    def clusters_pick_new_pitch(self, changing, not_changing):
 
         ### Pick only allowed harmonies
         holdovers = [i[-1].pitch for i in not_changing]
@@ -261,55 +434,44 @@ class Movement3(object):
 
         previous_pitch = changing.get_last_pitched().pitch
 
-        pitch_options = []
-        weights = []
+        candidates = self.clusters_candidates(changing, holdovers)
 
-        if allow_repeated_pitch:
-            available_pitches = changing.cluster_range[:]
+        # Only repeat the current pitch if nothing else is allowed
+        options = [c for c in candidates if c[0] != changing[-1].pitch]
+        if options:
+            self.stats['dont_allow_repeated_pitch'] += 1
         else:
-            available_pitches = [p for p in changing.cluster_range if p is not changing[-1].pitch]
-
-        bar_number = int(changing.duration() % 4)
-
-        for pitch_option in available_pitches:
-            harmony = holdovers + [pitch_option]
-            harmony.sort()
-            harmony = [ps - harmony[0] for ps in harmony]
-
-            harmony = list(set(harmony))
-            harmony.sort()
-            harmony = tuple(harmony)
-
-            if harmony in ALLOWED_HARMONIES:
-                pitch_options.append(pitch_option)
+            self.stats['allow_repeated_pitch'] += 1
+            options = candidates
 
-                # The further away the new pitch from the previous pitch, the lower the weight
-                distance = abs(previous_pitch - pitch_option)
-                distance_weight = DISTANCE_WEIGHTS[distance]
+        chord = BLUES_PROGRESSION[int(changing.duration() % 4)]
 
-                harmony_weight = ALLOWED_HARMONIES[harmony]
+        params = self.params
+        distance_factor = params['distance_weight']
+        harmony_factor = params['harmony_weight']
+        ascent_factor = params['ascent_weight']
 
-                blues_weight = 1
-                if pitch_option % 12 in BLUES_PROGRESSION[bar_number]:
-                    blues_weight = 3
+        pitch_options = []
+        weights = []
+        for pitch_option, harmony_weight in options:
+            pitch_options.append(pitch_option)
 
-                # weight the different weights
-                weight = ((distance_weight * 1.0) + (harmony_weight * .33)) * blues_weight
+            # The further away the new pitch from the previous pitch, the lower the weight
+            distance_weight = DISTANCE_WEIGHTS[abs(previous_pitch - pitch_option)]
 
-                if pitch_option > previous_pitch:
-                    weight *= 1.5
+            blues_weight = 1
+            if pitch_option % 12 in chord:
+                blues_weight = params['blues_weight']
 
-                weights.append(weight)
+            # weight the different weights
+            weight = ((distance_weight * distance_factor) + (harmony_weight * harmony_factor)) * blues_weight
 
-        new_pitch = weighted_choice(pitch_options, weights)
+            if pitch_option > previous_pitch:
+                weight *= ascent_factor
 
-        if new_pitch == None:
-            self.stats['allow_repeated_pitch'] += 1
-            new_pitch = self.clusters_pick_new_pitch(changing, not_changing, allow_repeated_pitch=True)
-        else:
-            self.stats['dont_allow_repeated_pitch'] += 1
+            weights.append(weight)
 
-        return new_pitch
+        return weighted_choice(pitch_options, weights)
 
     def bass_next(self):
         bar_number = self.bass.duration() // 4
@@ -319,56 +481,78 @@ class Movement3(object):
 
         previous_pitch = self.bass.get_last_pitched().pitch
 
-        pitch_options = []
-        weights = []
+        pitch = self.bass_pitch_sampler(previous_pitch, BLUES_PROGRESSION[bar_in_progression]).choice()
 
-        available_pitches = range(35, 52)
-        for pitch_option in available_pitches:
-            weight = 1.0
-
-            if pitch_option % 12 not in SCALE:
-                weight = .1
-
-            if pitch_option % 12 in BLUES_PROGRESSION[bar_in_progression]:
-                weight = 8.0
+        duration = self.bass_durations[beat_number].choice()
+        self.stats['bass_durations'][duration] += 1
 
+        self.bass.add_note(pitch=pitch, duration=duration)
 
-            # The further away the new pitch from the previous pitch, the lower the weight
-            distance = abs(previous_pitch - pitch_option)
-
-            if distance == 0:
-                weight = 1.0
-            else:
-                if distance < 3:
-                    weight = weight * 8
-                elif distance < 6:
-                    weight = weight * 4
-                # elif distance < 9:
-                #     weight = weight * 2
-                elif distance > 12:
-                    weight = .125
+    def bass_pitch_weight(self, pitch_option, previous_pitch, chord):
+        weight = 1.0
 
-            pitch_options.append(pitch_option)
-            weights.append(weight)
+        if pitch_option % 12 not in SCALE:
+            weight = .1
 
-        pitch = weighted_choice(pitch_options, weights)
+        if pitch_option % 12 in chord:
+            weight = 8.0
 
-        if beat_number == 0:
-            duration_options = [1,  2,  3, 4, 5, 6, 7, 8]
-            duration_weights = [35, 24, 2, 6, 1, 1, 1, 2]
-        elif beat_number == 1:
-            duration_options = [1,  2,  3,  4, 5, 6, 7]
-            duration_weights = [35, 12, 16, 1, 1, 1, 3]
-        elif beat_number == 2:
-            duration_options = [1,  2,  4, 6]
-            duration_weights = [24, 24, 1, 2]
-        elif beat_number == 3:
-            duration_options = [1,  2, 5]
-            duration_weights = [40, 2, 5]
 
-        duration = weighted_choice(duration_options, duration_weights)
+        # The further away the new pitch from the previous pitch, the lower the weight
+        distance = abs(previous_pitch - pitch_option)
 
-        self.bass.add_note(pitch=pitch, duration=duration)
+        if distance == 0:
+            weight = 1.0
+        else:
+            if distance < 3:
+                weight = weight * 8
+            elif distance < 6:
+                weight = weight * 4
+            # elif distance < 9:
+            #     weight = weight * 2
+            elif distance > 12:
+                weight = .125
+
+        return weight
+
+    def bass_pitch_sampler(self, previous_pitch, chord):
+        """The distribution of the next bass pitch only depends on the
+        previous pitch, the chord and the scale, so build a sampler for each
+        once. Changing BLUES_PROGRESSION or SCALE gives new keys; call
+        clear_transition_tables after changing bass_pitch_weight,
+        ALLOWED_HARMONIES or a cluster_range."""
+        key = (previous_pitch, chord, SCALE)
+        sampler = self._bass_pitch_samplers.get(key)
+        if sampler is None:
+            pitch_options = range(35, 52)
+            weights = [self.bass_pitch_weight(p, previous_pitch, chord) for p in pitch_options]
+            sampler = WeightedSampler(pitch_options, weights)
+            self._bass_pitch_samplers[key] = sampler
+        return sampler
+
+    def clear_transition_tables(self):
+        """Pick up the shared tables for the current ALLOWED_HARMONIES,
+        SCALE, cluster ranges and bass_pitch_weight, building them as they're
+        needed if no Movement3 has used that combination yet."""
+        key = (
+            getattr(self.bass_pitch_weight, '__func__', self.bass_pitch_weight),
+            tuple(sorted(ALLOWED_HARMONIES.items())),
+            SCALE,
+            tuple((i.name, tuple(i.cluster_range)) for i in self.clusters),
+        )
+        tables = _transition_tables.get(key)
+        if tables is None:
+            tables = _transition_tables[key] = ({}, {})
+        self._bass_pitch_samplers, self._cluster_candidates = tables
+
+
+def generate(seed, duration=120.0, params=None):
+    """A Movement3 generated quietly from `seed`, the same in any process."""
+    random.seed(seed)
+    return Movement3(duration=duration, verbose=False, params=params)
+
+
+profiling.register(Movement3, 'go', 'clusters_next', 'clusters_pick_new_pitch', 'bass_next', 'notate')
 
 
 if __name__ == '__main__':
@@ -379,7 +563,58 @@ if __name__ == '__main__':
         '--dont-notate',
         help='dont generate notation',
         action="store_true")
+    parser.add_argument(
+        '-x',
+        '--musicxml',
+        help='write MusicXML to this path, without music21')
+    parser.add_argument(
+        '-m',
+        '--midi',
+        help='write a MIDI file to this path, without music21')
+    parser.add_argument(
+        '-s',
+        '--snapshot',
+        help='save the music to this path, to load with snapshot_tools.read_snapshot')
+    parser.add_argument(
+        '-l',
+        '--length',
+        help='seconds of music to generate (default 120)',
+        type=float)
+    parser.add_argument(
+        '-c',
+        '--checkpoint',
+        help='save a checkpoint to this path, to carry on from with --resume')
+    parser.add_argument(
+        '-r',
+        '--resume',
+        help='carry on from this checkpoint, up to --length if given')
+    parser.add_argument(
+        '-o',
+        '--output',
+        help='notate to OUTPUT.xml and OUTPUT.mid instead of opening a notation app')
+    parser.add_argument(
+        '-p',
+        '--profile',
+        help='time each phase and run cProfile, reported with the stats',
+        action="store_true")
     args = parser.parse_args()
-    m3 = Movement3()
-    if not args.dont_notate:
+    if args.profile:
+        profiling.enable(profile=True, trace_memory=True)
+    if args.resume:
+        m3 = Movement3.resume(args.resume, args.length)
+    else:
+        m3 = Movement3(args.length or 120.0)
+    if args.checkpoint:
+        m3.save_checkpoint(args.checkpoint)
+    if args.musicxml:
+        m3.write_musicxml(args.musicxml)
+    if args.midi:
+        m3.write_midi(args.midi)
+    if args.snapshot:
+        m3.write_snapshot(args.snapshot)
+    if args.output:
+        m3.notate(show=False, musicxml_path=args.output + '.xml', midi_path=args.output + '.mid')
+    elif not args.dont_notate:
         m3.notate()
+    if args.profile and (args.output or not args.dont_notate):
+        profiling.print_report()
@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+"""Generate many realizations of Movement3 at once.
+
+Each realization is a lane. All lanes advance in lockstep, one Movement3
+event per step, with their state held in NumPy arrays and every candidate
+pitch and duration scored with array operations. The rules and weights are
+the ones in movement3.py, and take the same `params`, but random numbers
+come from one NumPy stream, so a lane won't match a Movement3 run with the
+same seed.
+
+Needs numpy.
+
+"""
+
+from collections import Counter
+
+import numpy as np
+
+from music_tools import Music
+from utils import WeightedSampler
+from movement3 import (
+    ALLOWED_HARMONIES,
+    DISTANCE_WEIGHTS,
+    BLUES_PROGRESSION,
+    SCALE,
+    BASS_DURATIONS,
+    CLUSTER_RESTS,
+    CLUSTER_LONG_RESTS,
+    DEFAULT_PARAMS,
+)
+
+
+INSTRUMENT_NAMES = (
+    'violin',
+    'flute',
+    'oboe',
+    'clarinet',
+    'alto_saxophone',
+    'trumpet',
+    'bass'
+)
+CLUSTER_NAMES = ('flute', 'oboe', 'clarinet')
+
+# Pitch code used for rests in the note arrays
+REST = -1
+
+CLUSTER_LOWEST_PITCH = 70
+CLUSTER_PITCHES = np.arange(CLUSTER_LOWEST_PITCH, 97)
+BASS_PITCHES = np.arange(35, 52)
+
+# For each changing cluster instrument, the two that hold over
+NOT_CHANGING = np.array([[1, 2], [0, 2], [0, 1]])
+
+NICE_DYADS = np.array([0, 1, 2, 7, 12])
+NICE_DURATIONS_TO_ADD = np.array([1.0, 2.0, 2.0, 2.0, 3.0, 4.0])
+DURATIONS_TO_ADD = np.array([1.0, 1.0, 1.0, 2.0])
+NOTE_DURATIONS = np.array([1, 1, 1, 1, 1, 2, 2, 3], dtype=float)
+
+# Largest chord type interval kept in the harmony counts
+MAX_INTERVAL = 64
+
+
+def _make_cluster_ranges():
+    from instrument_data import instrument_data
+    ranges = np.zeros((len(CLUSTER_NAMES), len(CLUSTER_PITCHES)), dtype=bool)
+    for i, name in enumerate(CLUSTER_NAMES):
+        ranges[i] = np.in1d(CLUSTER_PITCHES, instrument_data[name]['range'])
+    return ranges
+
+
+def _make_harmony_weights():
+    """ALLOWED_HARMONIES weight of adding each candidate pitch to each pair
+    of holdover pitches, 0 where the harmony isn't allowed.
+
+    Indexed by [lower holdover, higher holdover, candidate], all as offsets
+    into CLUSTER_PITCHES.
+
+    """
+    n = len(CLUSTER_PITCHES)
+    weights = np.zeros((n, n, n))
+    for lo in range(n):
+        for hi in range(lo, n):
+            for candidate in range(n):
+                harmony = sorted(set([0, hi - lo, candidate - lo]))
+                harmony = tuple(p - harmony[0] for p in harmony)
+                weights[lo, hi, candidate] = ALLOWED_HARMONIES.get(harmony, 0.0)
+    return weights
+
+
+def _sampler_table(samplers):
+    """Pad the cumulative weights of several WeightedSamplers into arrays."""
+    width = max(len(s.options) for s in samplers)
+    options = np.zeros((len(samplers), width))
+    weights = np.zeros((len(samplers), width))
+    for i, sampler in enumerate(samplers):
+        options[i, :len(sampler.options)] = sampler.options
+        weights[i, :len(sampler.options)] = np.diff([0] + sampler.cumulative)
+    return options, weights
+
+
+def _make_blues_weights(blues_weight):
+    """Blues weight of each cluster pitch class, by beat within the bar."""
+    weights = np.ones((4, 12))
+    for beat in range(4):
+        weights[beat, list(BLUES_PROGRESSION[beat])] = blues_weight
+    return weights
+
+
+CLUSTER_RANGES = _make_cluster_ranges()
+HARMONY_WEIGHTS = _make_harmony_weights()
+DISTANCE_WEIGHT_ARRAY = np.array(DISTANCE_WEIGHTS)
+
+CLUSTER_BLUES_WEIGHTS = _make_blues_weights(DEFAULT_PARAMS['blues_weight'])
+
+# Bass pitch weight before distance is taken into account, by bar of the
+# progression
+BASS_HARMONY_WEIGHTS = np.ones((len(BLUES_PROGRESSION), len(BASS_PITCHES)))
+for _bar, _chord in enumerate(BLUES_PROGRESSION):
+    _pcs = BASS_PITCHES % 12
+    BASS_HARMONY_WEIGHTS[_bar, ~np.in1d(_pcs, SCALE)] = .1
+    BASS_HARMONY_WEIGHTS[_bar, np.in1d(_pcs, _chord)] = 8.0
+
+BASS_DURATION_OPTIONS, BASS_DURATION_WEIGHTS = _sampler_table([BASS_DURATIONS[b] for b in range(4)])
+REST_OPTIONS, REST_WEIGHTS = _sampler_table([CLUSTER_RESTS, CLUSTER_LONG_RESTS])
+
+
+def _choose(rng, weights):
+    """Pick a column of each row of `weights`, with probability proportional
+    to its weight."""
+    cumulative = np.cumsum(weights, axis=1)
+    rand = rng.random_sample(len(weights)) * cumulative[:, -1]
+    chosen = (cumulative <= rand[:, np.newaxis]).sum(axis=1)
+    # Rounding can put `rand` right at the total
+    last_weighted = weights.shape[1] - 1 - np.argmax(weights[:, ::-1] > 0, axis=1)
+    return np.minimum(chosen, last_weighted)
+
+
+class _Parts(object):
+    """Notes of one instrument in every lane, as growable 2-D arrays."""
+    def __init__(self, n_lanes, capacity=64):
+        self.pitches = np.zeros((n_lanes, capacity), dtype=np.int16)
+        self.durations = np.zeros((n_lanes, capacity))
+        self.counts = np.zeros(n_lanes, dtype=np.intp)
+
+    def _grow(self):
+        capacity = self.pitches.shape[1] * 2
+        pitches = np.zeros((len(self.counts), capacity), dtype=np.int16)
+        durations = np.zeros((len(self.counts), capacity))
+        pitches[:, :self.pitches.shape[1]] = self.pitches
+        durations[:, :self.durations.shape[1]] = self.durations
+        self.pitches = pitches
+        self.durations = durations
+
+    def add_notes(self, lanes, pitches, durations):
+        if len(lanes) and self.counts[lanes].max() >= self.pitches.shape[1]:
+            self._grow()
+        positions = self.counts[lanes]
+        self.pitches[lanes, positions] = pitches
+        self.durations[lanes, positions] = durations
+        self.counts[lanes] += 1
+
+    def lengthen_last(self, lanes, durations):
+        self.durations[lanes, self.counts[lanes] - 1] += durations
+
+    def notes(self, lane):
+        count = self.counts[lane]
+        for pitch, duration in zip(self.pitches[lane, :count], self.durations[lane, :count]):
+            if pitch == REST:
+                yield 'rest', float(duration)
+            else:
+                yield int(pitch), float(duration)
+
+
+class Movement3Batch(object):
+    """`n_lanes` realizations of Movement3, each `duration` seconds long,
+    with `params` overriding movement3.DEFAULT_PARAMS as for Movement3."""
+    def __init__(self, n_lanes=16, duration=120.0, seed=None, starting_tempo_bpm=160, params=None):
+        self.n_lanes = n_lanes
+        self.rng = np.random.RandomState(seed)
+        self.starting_tempo_bpm = starting_tempo_bpm
+        self.beat_seconds = 60.0 / starting_tempo_bpm
+
+        self.setup(params)
+        self.first()
+        self.go(duration)
+
+    def setup(self, params=None):
+        self.params = dict(DEFAULT_PARAMS, **(params or {}))
+        self.cluster_blues_weights = CLUSTER_BLUES_WEIGHTS
+        if self.params['blues_weight'] != DEFAULT_PARAMS['blues_weight']:
+            self.cluster_blues_weights = _make_blues_weights(self.params['blues_weight'])
+        self.bass_duration_options = BASS_DURATION_OPTIONS
+        self.bass_duration_weights = BASS_DURATION_WEIGHTS
+        if self.params['bass_durations']:
+            self.bass_duration_options, self.bass_duration_weights = _sampler_table(
+                [WeightedSampler(*table) for table in self.params['bass_durations']])
+
+    def first(self):
+        k = self.n_lanes
+        lanes = np.arange(k)
+
+        # Cluster state, one column per instrument in CLUSTER_NAMES
+        self.clusters = [_Parts(k) for _ in CLUSTER_NAMES]
+        self.cluster_pitch = np.tile([84, 83, 82], (k, 1))
+        self.cluster_last_duration = np.full((k, 3), 2.0)
+        self.cluster_total = np.full((k, 3), 2.0)
+        # Beats since the last rest of at least 1 and 4 beats
+        self.since_rest = np.full((k, 3), 2.0)
+        self.since_long_rest = np.full((k, 3), 2.0)
+        for i, parts in enumerate(self.clusters):
+            parts.add_notes(lanes, self.cluster_pitch[:, i], 2.0)
+
+        self.bass = _Parts(k)
+        self.bass_pitch = np.full(k, 48)
+        self.bass_total = np.full(k, 1.0)
+        self.bass.add_notes(lanes, 48, 1.0)
+
+        # The thirds and violin hold one note, as in Movement3.first
+        self.held_notes = {
+            'alto_saxophone': (67, 16),
+            'trumpet': (64, 16),
+            'violin': (67, 16),
+        }
+        self.held_duration = 16.0
+
+        self.harmony_counts = np.zeros((k, MAX_INTERVAL * MAX_INTERVAL), dtype=np.int32)
+        self.rest_counts = [Counter() for _ in range(k)]
+        self.repeated_pitch_counts = np.zeros(k, dtype=np.int32)
+        self.cluster_events = np.zeros(k, dtype=np.int32)
+        # Bass notes chosen, by lane, beat within the bar and option
+        self.bass_duration_counts = np.zeros((k,) + self.bass_duration_options.shape, dtype=np.int32)
+
+    def duration_seconds(self):
+        beats = np.maximum(self.cluster_total.max(axis=1), self.bass_total)
+        beats = np.maximum(beats, self.held_duration)
+        return beats * self.beat_seconds
+
+    def go(self, duration=120.0):
+        while True:
+            lanes = np.nonzero(self.duration_seconds() < duration)[0]
+            if not len(lanes):
+                break
+            self.next(lanes)
+
+    def next(self, lanes):
+        self.clusters_next(lanes)
+        self.bass_next(lanes)
+
+    def _lengthen_cluster(self, lanes, instruments, durations):
+        self.cluster_last_duration[lanes, instruments] += durations
+        self.cluster_total[lanes, instruments] += durations
+        self.since_rest[lanes, instruments] += durations
+        self.since_long_rest[lanes, instruments] += durations
+
+    def clusters_next(self, lanes):
+        rng = self.rng
+        n = len(lanes)
+        changing = _choose(rng, self.since_rest[lanes] * self.beat_seconds)
+        not_changing = NOT_CHANGING[changing]
+        new_pitch = self.clusters_pick_new_pitch(lanes, changing, not_changing)
+
+        event_duration = np.zeros(n)
+
+        resting = rng.randint(2, 18, n) < self.since_rest[lanes, changing]
+        if resting.any():
+            r_lanes = lanes[resting]
+            r_changing = changing[resting]
+
+            # If the last note in the phrase was a quarter note, make it longer
+            extend = self.cluster_last_duration[r_lanes, r_changing] == 1
+            if extend.any():
+                e_lanes = r_lanes[extend]
+                holdovers = self.cluster_pitch[e_lanes[:, np.newaxis], not_changing[resting][extend]]
+                revealed_harmony = holdovers.max(axis=1) - holdovers.min(axis=1)
+                nice = np.in1d(revealed_harmony, NICE_DYADS)
+                to_add = np.where(
+                    nice,
+                    NICE_DURATIONS_TO_ADD[rng.randint(0, len(NICE_DURATIONS_TO_ADD), len(e_lanes))],
+                    DURATIONS_TO_ADD[rng.randint(0, len(DURATIONS_TO_ADD), len(e_lanes))]
+                )
+                for i, parts in enumerate(self.clusters):
+                    self._lengthen_cluster(e_lanes, i, to_add)
+                    parts.lengthen_last(e_lanes, to_add)
+
+            for lane, beats in zip(r_lanes, self.since_rest[r_lanes, r_changing]):
+                self.rest_counts[lane][float(beats)] += 1
+
+            # Add a rest before the next note
+            long_rest = (self.since_long_rest[r_lanes, r_changing] > 40) & (rng.random_sample(len(r_lanes)) < .5)
+            table = long_rest.astype(int)
+            rest_duration = REST_OPTIONS[table, _choose(rng, REST_WEIGHTS[table])]
+
+            for i, parts in enumerate(self.clusters):
+                mine = r_changing == i
+                parts.add_notes(r_lanes[mine], REST, rest_duration[mine])
+            self.cluster_total[r_lanes, r_changing] += rest_duration
+            self.since_rest[r_lanes, r_changing] = rest_duration
+            self.since_long_rest[r_lanes, r_changing] = np.where(
+                rest_duration >= 4,
+                rest_duration,
+                self.since_long_rest[r_lanes, r_changing] + rest_duration
+            )
+            event_duration[resting] += rest_duration
+
+        note_duration = NOTE_DURATIONS[rng.randint(0, len(NOTE_DURATIONS), n)]
+        event_duration += note_duration
+
+        for i, parts in enumerate(self.clusters):
+            mine = changing == i
+            parts.add_notes(lanes[mine], new_pitch[mine], note_duration[mine])
+        self.cluster_pitch[lanes, changing] = new_pitch
+        self.cluster_last_duration[lanes, changing] = note_duration
+        self.cluster_total[lanes, changing] += note_duration
+        self.since_rest[lanes, changing] += note_duration
+        self.since_long_rest[lanes, changing] += note_duration
+
+        for column in range(2):
+            holding = not_changing[:, column]
+            self._lengthen_cluster(lanes, holding, event_duration)
+            for i, parts in enumerate(self.clusters):
+                mine = holding == i
+                parts.lengthen_last(lanes[mine], event_duration[mine])
+
+        pitches = np.sort(self.cluster_pitch[lanes], axis=1)
+        intervals = pitches[:, 1:] - pitches[:, :1]
+        harmony = intervals[:, 0] * MAX_INTERVAL + intervals[:, 1]
+        np.add.at(self.harmony_counts, (lanes, harmony), 1)
+        self.cluster_events[lanes] += 1
+
+    def clusters_pick_new_pitch(self, lanes, changing, not_changing):
+        holdovers = np.sort(self.cluster_pitch[lanes[:, np.newaxis], not_changing], axis=1) - CLUSTER_LOWEST_PITCH
+        previous_pitch = self.cluster_pitch[lanes, changing]
+        beat = (self.cluster_total[lanes, changing] % 4).astype(int)
+
+        harmony_weight = HARMONY_WEIGHTS[holdovers[:, 0], holdovers[:, 1]]
+        distance = np.abs(previous_pitch[:, np.newaxis] - CLUSTER_PITCHES)
+        distance_weight = DISTANCE_WEIGHT_ARRAY[distance]
+        blues_weight = self.cluster_blues_weights[beat][:, CLUSTER_PITCHES % 12]
+
+        params = self.params
+        weights = ((distance_weight * params['distance_weight']) + (harmony_weight * params['harmony_weight'])) * blues_weight
+        weights[CLUSTER_PITCHES > previous_pitch[:, np.newaxis]] *= params['ascent_weight']
+        weights *= (harmony_weight > 0) & CLUSTER_RANGES[changing]
+
+        # Only repeat the previous pitch if nothing else is allowed
+        without_repeats = np.where(distance == 0, 0.0, weights)
+        repeating = without_repeats.sum(axis=1) == 0
+        weights = np.where(repeating[:, np.newaxis], weights, without_repeats)
+        self.repeated_pitch_counts[lanes] += repeating
+
+        return CLUSTER_PITCHES[_choose(self.rng, weights)]
+
+    def bass_next(self, lanes):
+        rng = self.rng
+        total = self.bass_total[lanes]
+        bar_in_progression = (total // 4).astype(int) % len(BLUES_PROGRESSION)
+        beat_number = (total % 4).astype(int)
+        previous_pitch = self.bass_pitch[lanes]
+
+        weights = BASS_HARMONY_WEIGHTS[bar_in_progression]
+        distance = np.abs(previous_pitch[:, np.newaxis] - BASS_PITCHES)
+        weights = np.where(distance < 3, weights * 8, weights)
+        weights = np.where((distance >= 3) & (distance < 6), weights * 4, weights)
+        weights = np.where(distance > 12, .125, weights)
+        weights = np.where(distance == 0, 1.0, weights)
+
+        pitch = BASS_PITCHES[_choose(rng, weights)]
+        option = _choose(rng, self.bass_duration_weights[beat_number])
+        duration = self.bass_duration_options[beat_number, option]
+        np.add.at(self.bass_duration_counts, (lanes, beat_number, option), 1)
+
+        self.bass.add_notes(lanes, pitch, duration)
+        self.bass_pitch[lanes] = pitch
+        self.bass_total[lanes] += duration
+
+    def music(self, lane):
+        """Lane `lane` as a normal music_tools.Music."""
+        music = Music(instrument_names=INSTRUMENT_NAMES)
+        for name, (pitch, duration) in self.held_notes.items():
+            music.grid[name].add_note(pitch=pitch, duration=duration)
+        for name, parts in zip(CLUSTER_NAMES, self.clusters):
+            for pitch, duration in parts.notes(lane):
+                music.grid[name].add_note(pitch=pitch, duration=duration)
+        for pitch, duration in self.bass.notes(lane):
+            music.bass.add_note(pitch=pitch, duration=duration)
+        return music
+
+    def stats(self, lane):
+        """Lane `lane`'s stats, laid out like Movement3.stats."""
+        stats = Counter()
+        stats['beats_since_last_rest'] = Counter()
+        stats['harmonies'] = Counter()
+        stats['bass_durations'] = Counter()
+
+        for harmony in np.nonzero(self.harmony_counts[lane])[0]:
+            low, high = divmod(int(harmony), MAX_INTERVAL)
+            chord_type = tuple(sorted(set([0, low, high])))
+            stats['harmonies'][chord_type] += int(self.harmony_counts[lane, harmony])
+
+        stats['beats_since_last_rest'].update(self.rest_counts[lane])
+
+        for beat, option in zip(*np.nonzero(self.bass_duration_counts[lane])):
+            duration = self.bass_duration_options[beat, option].item()
+            stats['bass_durations'][duration] += int(self.bass_duration_counts[lane, beat, option])
+
+        repeated = int(self.repeated_pitch_counts[lane])
+        if repeated:
+            stats['allow_repeated_pitch'] = repeated
+        stats['dont_allow_repeated_pitch'] = int(self.cluster_events[lane]) - repeated
+        stats['duration'] = float(self.duration_seconds()[lane])
+        return stats
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--lanes', help='number of realizations', type=int, default=16)
+    parser.add_argument('-d', '--duration', help='seconds of music per realization', type=float, default=120.0)
+    parser.add_argument('-s', '--seed', type=int)
+    args = parser.parse_args()
+
+    start = time.time()
+    batch = Movement3Batch(n_lanes=args.lanes, duration=args.duration, seed=args.seed)
+    seconds = time.time() - start
+    n_events = batch.cluster_events.sum()
+    print '{} realizations, {} cluster events in {:.3f}s ({:.0f} events/s)'.format(
+        args.lanes, n_events, seconds, n_events / seconds)
@@ -1,34 +1,74 @@
 #!/usr/bin/env python
 
-import math
+import os
+import heapq
+import itertools
+from array import array
+from bisect import bisect_right
 
-from notation_tools import Notation
+from notation_tools import Notation, BackgroundExporter
 from instrument_data import instrument_data
 import utils
+import profiling
 
 
 def range16ths(start, end, step=.25):
     return [n / 4.0 for n in xrange(int(start * 4), int(end * 4), int(step * 4))]
 
 
+# Ticks per beat of the integer time base. Divisible by 2, 3, 4, 5, 7 and 8,
+# so triplets, quintuplets, septuplets and 32nd notes are exact.
+TICKS_PER_BEAT = 840
+
+
+def beats_to_ticks(beats):
+    ticks = beats * TICKS_PER_BEAT
+    rounded = int(round(ticks))
+    if abs(ticks - rounded) > 1e-6:
+        raise ValueError('{} beats is not a whole number of ticks'.format(beats))
+    return rounded
+
+
+def ticks_to_beats(ticks):
+    # Whole beats come back as ints, like the durations that add up to them
+    beats, remainder = divmod(ticks, TICKS_PER_BEAT)
+    if remainder:
+        return ticks / float(TICKS_PER_BEAT)
+    return beats
+
+
 def meter_position(tick):
-    position_within_beat, beat = math.modf(tick)
-    beat = int(beat)
+    beat, position_within_beat = divmod(beats_to_ticks(tick), TICKS_PER_BEAT)
     beat_within_bar = beat % 4
     bar_number = beat // 4
-    return bar_number, beat_within_bar, position_within_beat
+    return bar_number, beat_within_bar, position_within_beat / float(TICKS_PER_BEAT)
 
 
 def beats_to_seconds(beats, bpm=60):
     return beats / (bpm / 60.0)
 
 
+# Harmonies are represented as 12-bit pitch-class masks: bit n is set when
+# pitch class n sounds. Tables over all 4096 masks make lookups O(1).
+N_MASKS = 1 << 12
+
+
+def pitches_to_mask(pitches):
+    mask = 0
+    for p in pitches:
+        mask |= 1 << (p % 12)
+    return mask
+
+
+_mask_pitchclasses = [tuple(pc for pc in range(12) if mask >> pc & 1) for mask in xrange(N_MASKS)]
+
+
+def mask_to_pitchclasses(mask):
+    return _mask_pitchclasses[mask]
+
+
 def pitches_to_pitchclasses(pitches):
-    pitchclasses = [p % 12 for p in pitches]
-    pitchclasses = list(set(pitchclasses))
-    pitchclasses.sort()
-    pitchclasses = tuple(pitchclasses)
-    return pitchclasses
+    return _mask_pitchclasses[pitches_to_mask(pitches)]
 
 
 def pitches_to_chord_type(pitches):
@@ -39,13 +79,62 @@ def pitches_to_chord_type(pitches):
     return tuple(chord_type)
 
 
+# Chord types (intervals above the lowest pitch, not reduced to an octave)
+# interned as small ints, so they are cheap to compare. The ids are only
+# meaningful in the process that made them; anything saved or sent to
+# another process should use the chord type tuples.
+_chord_types = []
+_chord_type_ids = {}
+_chord_type_ids_by_pitches = {}
+
+# Pitch tuples remembered by pitches_to_chord_type_id before starting over
+MAX_CACHED_PITCHES = 1 << 16
+
+
+def intern_chord_type(chord_type):
+    chord_type_id = _chord_type_ids.get(chord_type)
+    if chord_type_id is None:
+        chord_type_id = len(_chord_types)
+        _chord_types.append(chord_type)
+        _chord_type_ids[chord_type] = chord_type_id
+    return chord_type_id
+
+
+def chord_type_from_id(chord_type_id):
+    return _chord_types[chord_type_id]
+
+
+def pitches_to_chord_type_id(pitches):
+    key = tuple(pitches)
+    chord_type_id = _chord_type_ids_by_pitches.get(key)
+    if chord_type_id is None:
+        chord_type_id = intern_chord_type(pitches_to_chord_type(key))
+        if len(_chord_type_ids_by_pitches) >= MAX_CACHED_PITCHES:
+            _chord_type_ids_by_pitches.clear()
+        _chord_type_ids_by_pitches[key] = chord_type_id
+    return chord_type_id
+
+
+def pitches_to_interned_chord_type(pitches):
+    """Like pitches_to_chord_type, but cached, and always the same tuple
+    object for the same chord type."""
+    return _chord_types[pitches_to_chord_type_id(pitches)]
+
+
+_inversions = {}
+
+
 def get_inversions(pitchclasses):
-    inversions = []
-    for p1 in pitchclasses:
-        inversion = [(p2 - p1) % 12 for p2 in pitchclasses]
-        inversion.sort()
-        inversions.append(tuple(inversion))
-    return inversions
+    key = tuple(pitchclasses)
+    inversions = _inversions.get(key)
+    if inversions is None:
+        inversions = []
+        for p1 in key:
+            inversion = [(p2 - p1) % 12 for p2 in key]
+            inversion.sort()
+            inversions.append(tuple(inversion))
+        _inversions[key] = inversions
+    return list(inversions)
 
 
 def make_allowed_harmonies():
@@ -98,8 +187,42 @@ def make_allowed_harmonies():
 allowed_harmonies = make_allowed_harmonies()
 
 
+def _make_allowed_masks(harmonies):
+    harmonies = set(harmonies)
+    return [_mask_pitchclasses[mask] in harmonies for mask in xrange(N_MASKS)]
+
+
+_allowed_masks = _make_allowed_masks(allowed_harmonies)
+
+
+def is_mask_allowed(mask):
+    return _allowed_masks[mask]
+
+
 def is_harmony_allowed(pitches):
-    return tuple(pitches_to_pitchclasses(pitches)) in allowed_harmonies
+    return _allowed_masks[pitches_to_mask(pitches)]
+
+
+def _make_completion_costs(allowed_masks):
+    """For every mask, the fewest pitch classes that must be added to it to
+    reach an allowed harmony (N_MASKS if no allowed superset exists)."""
+    costs = [0 if allowed else N_MASKS for allowed in allowed_masks]
+    by_size = sorted(xrange(N_MASKS), key=lambda mask: -len(_mask_pitchclasses[mask]))
+    for mask in by_size:
+        for pc in range(12):
+            bigger = mask | (1 << pc)
+            if bigger != mask and costs[bigger] + 1 < costs[mask]:
+                costs[mask] = costs[bigger] + 1
+    return costs
+
+
+_completion_costs = _make_completion_costs(_allowed_masks)
+
+
+def can_complete_harmony(mask, n_pitchclasses):
+    """Could adding up to `n_pitchclasses` more pitch classes make `mask`
+    an allowed harmony?"""
+    return _completion_costs[mask] <= n_pitchclasses
 
 
 def get_intervals(pitches):
@@ -111,41 +234,120 @@ def get_intervals(pitches):
 class Tick(object):
     def __init__(self, tick):
         self.tick = tick
+        self.ticks = beats_to_ticks(tick)
         self.bar_number, self.beat_within_bar, self.position_within_beat = meter_position(tick)
 
 
+def is_pitched(pitch):
+    # A pitch can be 0, or a non-empty chord
+    return isinstance(pitch, int) or (isinstance(pitch, list) and bool(pitch))
+
+
 class Note(object):
     def __init__(self, pitch=None, duration=0.0):
-        self.pitch = pitch
-        self.duration = duration
+        # Instruments holding this note, told when it changes so they can fix
+        # up their onset index and tail state
+        self._owners = []
+
+        self._pitch = pitch
+        self._duration = duration
 
     def __repr__(self):
         return '<Note - pitch: {} duration: {}>'.format(self.pitch, self.duration)
 
+    def __getstate__(self):
+        """Everything but the owners, which adopt the note again as they
+        are rebuilt. Pickling them would go round the cycle through each
+        owner's notes before this note's state exists.
 
-class Instrument(list):
-    def __init__(self, inst_name):
+        >>> import pickle
+        >>> part = Instrument('violin')
+        >>> part.add_note(60, 1)
+        >>> note = pickle.loads(pickle.dumps(part[0], pickle.HIGHEST_PROTOCOL))
+        >>> note, note._owners
+        (<Note - pitch: 60 duration: 1>, [])
+
+        """
+        state = self.__dict__.copy()
+        del state['_owners']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._owners = []
+
+    def _notify(self, method_name):
+        notified = set()
+        for owner in self._owners:
+            if id(owner) not in notified:
+                notified.add(id(owner))
+                getattr(owner, method_name)(self)
+
+    @property
+    def pitch(self):
+        return self._pitch
+
+    @pitch.setter
+    def pitch(self, pitch):
+        self._pitch = pitch
+        self._notify('_note_repitched')
+
+    @property
+    def duration(self):
+        return self._duration
+
+    @duration.setter
+    def duration(self, duration):
+        self._duration = duration
+        self._notify('_note_changed')
+
+
+def _count_identical(items, target):
+    return sum(1 for item in items if item is target)
+
+
+def _remove_identical(items, target):
+    for i, item in enumerate(items):
+        if item is target:
+            del items[i]
+            return
+
+
+_registers_cache = {}
+
+# Marks tail state that has to be looked up again
+_UNKNOWN = object()
+
+
+class InstrumentInfo(object):
+    """Name, range and registers of an instrument, shared by the part
+    classes."""
+    def _setup_info(self, inst_name):
         self.name = inst_name
         self.abbreviation = instrument_data[self.name]['abbreviation']
         self.range = instrument_data[self.name]['range']
+        self.midi_program = instrument_data[self.name]['midi_program']
         self._make_registers()
 
-    def __repr__(self):
-        return '<music_tools.Instrument: {}>'.format(self.name)
-
     def _make_registers(self, n_chunks=7):
         self.lowest_note = self.range[0]
         self.highest_note = self.range[-1]
 
-        separators = []
-        for i in range(int(n_chunks) + 1):
-            separator = i * (len(self.range) / float(n_chunks))
-            separators.append(separator)
+        # Registers only depend on the range, and fragments make a lot of
+        # short-lived instruments, so only work them out once per instrument
+        key = (self.name, n_chunks)
+        registers = _registers_cache.get(key)
+        if registers is None:
+            separators = []
+            for i in range(int(n_chunks) + 1):
+                separator = i * (len(self.range) / float(n_chunks))
+                separators.append(separator)
 
-        registers = []
-        for a, b in utils.pairwise(separators):
-            chunk = [p for i, p in enumerate(self.range) if a <= i < b]
-            registers.append(chunk)
+            registers = []
+            for a, b in utils.pairwise(separators):
+                chunk = [p for i, p in enumerate(self.range) if a <= i < b]
+                registers.append(chunk)
+            _registers_cache[key] = registers
 
         self.middle_register = registers[3]  # assuming 7 divisions
         self.highest_register = registers[-1]
@@ -153,8 +355,196 @@ class Instrument(list):
         self.safe_register = utils.flatten(registers[1:-1])
         self.very_safe_register = utils.flatten(registers[2:-2])
 
+
+class Instrument(InstrumentInfo, list):
+    """A part: a list of Notes played one after another.
+
+    Keeps a running index of the offset at which each note ends, in whole
+    ticks (see TICKS_PER_BEAT), so `duration()` is constant time,
+    `get_at_tick()` is a binary search and offsets never drift. Note
+    durations must be a whole number of ticks.
+    The index is extended lazily on append and is invalidated from the
+    changed note on any other edit, including `instrument[-1].duration += x`.
+
+    It also keeps track of the last pitched note and of the last rest at
+    least as long as each threshold asked of `beats_since_last_rest()`, so
+    those are constant time while notes are only appended.
+
+    """
+    def __init__(self, inst_name):
+        list.__init__(self)
+        self._setup_info(inst_name)
+
+        # _ends[i] is the tick at which self[i] ends. Only the first
+        # len(_ends) entries are valid; the rest are rebuilt on demand.
+        self._ends = []
+
+        self._forget_tail()
+
+    def __repr__(self):
+        return '<music_tools.Instrument: {}>'.format(self.name)
+
+    def __reduce__(self):
+        """Pickle as a fresh part that the notes are added back to, so the
+        onset index, the tail state and the notes' owners are worked out
+        again. Pickle adds a list's items before it restores attributes,
+        so they can't come from the pickled state.
+
+        >>> import pickle
+        >>> part = Instrument('violin')
+        >>> part.add_note(60, 1)
+        >>> part.add_note('rest', 2)
+        >>> part.add_note(62, 1)
+        >>> part.beats_since_last_rest(2)
+        3.0
+        >>> copy = pickle.loads(pickle.dumps(part, pickle.HIGHEST_PROTOCOL))
+        >>> copy, copy.duration(), copy.beats_since_last_rest(2), copy.get_last_pitched()
+        (<music_tools.Instrument: violin>, 4, 3.0, <Note - pitch: 62 duration: 1>)
+        >>> copy[0]._owners == [copy]
+        True
+
+        """
+        state = dict(
+            (name, value) for name, value in self.__dict__.iteritems()
+            if name not in ('_ends', '_last_pitched', '_last_rests')
+        )
+        return self.__class__, (self.name,), state, iter(self)
+
+    # Onset index bookkeeping
+
+    def _invalidate(self, index=0, tail=True):
+        if index < len(self._ends):
+            del self._ends[index:]
+        if tail:
+            self._forget_tail()
+
+    def _forget_tail(self):
+        # Index of the last pitched note, or None if there isn't one
+        self._last_pitched = _UNKNOWN
+        # Index of the last rest at least `threshold` beats long, by threshold
+        self._last_rests = {}
+
+    def _track_tail(self, index, note):
+        if is_pitched(note.pitch):
+            self._last_pitched = index
+        elif note.pitch == 'rest':
+            for threshold in self._last_rests:
+                if note.duration >= threshold:
+                    self._last_rests[threshold] = index
+
+    def _update_index(self):
+        ends = self._ends
+        n_valid = len(ends)
+        if n_valid == len(self):
+            return ends
+        offset = ends[-1] if ends else 0
+        for i in xrange(n_valid, len(self)):
+            offset += beats_to_ticks(list.__getitem__(self, i).duration)
+            ends.append(offset)
+        return ends
+
+    def _note_changed(self, note):
+        # Edits almost always touch the tail, so search backwards. A note can
+        # appear more than once, so keep going until every copy is found.
+        remaining = _count_identical(note._owners, self)
+        for index in xrange(len(self) - 1, -1, -1):
+            if list.__getitem__(self, index) is note:
+                remaining -= 1
+                if not remaining:
+                    # Only a rest's length can move the last long rest
+                    self._invalidate(index, tail=note.pitch == 'rest')
+                    return
+        self._invalidate()
+
+    def _note_repitched(self, note):
+        self._forget_tail()
+
+    def _adopt(self, notes):
+        """Register as an owner of `notes` and return them, with anything
+        that isn't a Note, such as a CompactNote view, copied into one."""
+        adopted = []
+        for note in notes:
+            if not isinstance(note, Note):
+                note = Note(pitch=note.pitch, duration=note.duration)
+            note._owners.append(self)
+            adopted.append(note)
+        return adopted
+
+    def _release(self, notes):
+        for note in notes:
+            _remove_identical(note._owners, self)
+
+    def append(self, note):
+        note = self._adopt([note])[0]
+        list.append(self, note)
+        self._track_tail(len(self) - 1, note)
+
+    def extend(self, notes):
+        notes = self._adopt(notes)
+        start = len(self)
+        list.extend(self, notes)
+        for index, note in enumerate(notes, start):
+            self._track_tail(index, note)
+
+    def __iadd__(self, notes):
+        self.extend(notes)
+        return self
+
+    def insert(self, index, note):
+        list.insert(self, index, self._adopt([note])[0])
+        self._invalidate()
+
+    def pop(self, index=-1):
+        if index < 0:
+            index += len(self)
+        note = list.pop(self, index)
+        self._release([note])
+        self._invalidate(index)
+        return note
+
+    def remove(self, note):
+        index = self.index(note)
+        del self[index]
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            self._release(list.__getitem__(self, index))
+            value = self._adopt(value)
+        else:
+            self._release([list.__getitem__(self, index)])
+            value = self._adopt([value])[0]
+        list.__setitem__(self, index, value)
+        self._invalidate()
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            self._release(list.__getitem__(self, index))
+        else:
+            self._release([list.__getitem__(self, index)])
+        list.__delitem__(self, index)
+        self._invalidate()
+
+    def __setslice__(self, i, j, value):
+        self.__setitem__(slice(max(0, i), max(0, j)), value)
+
+    def __delslice__(self, i, j):
+        self.__delitem__(slice(max(0, i), max(0, j)))
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._invalidate()
+
+    def reverse(self):
+        list.reverse(self)
+        self._invalidate()
+
     def duration(self):
-        return sum([note.duration for note in self])
+        ends = self._ends
+        if len(ends) != len(self):
+            ends = self._update_index()
+        if not ends:
+            return 0
+        return ticks_to_beats(ends[-1])
 
     def get_tick(self):
         return Tick(self.duration())
@@ -163,30 +553,343 @@ class Instrument(list):
         self.append(Note(pitch=pitch, duration=duration))
 
     def get_at_tick(self, tick):
-        duration = 0
-        for note in self:
-            if duration <= tick < duration + note.duration:
-                return note
-            duration += note.duration
+        ends = self._update_index()
+        tick *= TICKS_PER_BEAT
+        index = bisect_right(ends, tick)
+        if index == len(ends):
+            return
+        start = ends[index - 1] if index else 0
+        if start <= tick:
+            return list.__getitem__(self, index)
+
+    def _last_rest_index(self, rest_duration):
+        index = self._last_rests.get(rest_duration, _UNKNOWN)
+        if index is _UNKNOWN:
+            index = None
+            for i in xrange(len(self) - 1, -1, -1):
+                note = list.__getitem__(self, i)
+                if note.pitch == 'rest' and note.duration >= rest_duration:
+                    index = i
+                    break
+            self._last_rests[rest_duration] = index
+        return index
 
     def beats_since_last_rest(self, rest_duration=1):
-        duration = 0.0
-        for note in reversed(self):
-            duration += note.duration
-            if note.pitch is 'rest':
-                if note.duration >= rest_duration:
+        """Beats since the start of the last rest at least `rest_duration`
+        long, or since the start of the part if there isn't one."""
+        index = self._last_rest_index(rest_duration)
+        if index is None:
+            return float(self.duration())
+        ends = self._update_index()
+        start = ends[index - 1] if index else 0
+        return float(ticks_to_beats(ends[-1] - start))
+
+    def get_last_pitched(self):
+        if self._last_pitched is _UNKNOWN:
+            self._last_pitched = None
+            for i in xrange(len(self) - 1, -1, -1):
+                if is_pitched(list.__getitem__(self, i).pitch):
+                    self._last_pitched = i
                     break
-        return duration
+        if self._last_pitched is not None:
+            return list.__getitem__(self, self._last_pitched)
+
+
+# Pitch codes CompactInstrument uses for things that aren't MIDI pitches.
+# Chords are CHORD_CODE - n for the nth entry in the chord table.
+REST_CODE = -1
+NONE_CODE = -2
+CHORD_CODE = -3
+
+
+class CompactNote(object):
+    """A view of one note of a CompactInstrument, with Note's interface."""
+    __slots__ = ('_part', '_index')
+
+    def __init__(self, part, index):
+        self._part = part
+        self._index = index
+
+    def __repr__(self):
+        return '<Note - pitch: {} duration: {}>'.format(self.pitch, self.duration)
+
+    @property
+    def pitch(self):
+        return self._part._decode_pitch(self._part._pitches[self._index])
+
+    @pitch.setter
+    def pitch(self, pitch):
+        self._part._pitches[self._index] = self._part._encode_pitch(pitch)
+        self._part._forget_tail()
+
+    @property
+    def duration(self):
+        return ticks_to_beats(self._part._durations[self._index])
+
+    @duration.setter
+    def duration(self, duration):
+        self._part._set_duration(self._index, beats_to_ticks(duration))
+
+
+class CompactInstrument(InstrumentInfo):
+    """A part stored as typed arrays instead of a list of Notes.
+
+    Pitches are ints, with REST_CODE, NONE_CODE and CHORD_CODE standing in
+    for 'rest', None and chords, whose pitches live in a side table. Each
+    distinct chord is in the table once, however many notes have it.
+    Durations are whole ticks (see TICKS_PER_BEAT), so every
+    duration has to be a whole number of ticks. Indexing and iteration give
+    CompactNote views, which can be edited like Notes.
+
+    Notes can only be appended; there is no insert or delete.
+
+    """
+    def __init__(self, inst_name):
+        self._setup_info(inst_name)
+        # Wide enough for a code for every chord, not just MIDI pitches
+        self._pitches = array('i')
+        self._durations = array('l')
+        self._ends = array('l')
+        self._chord_offsets = array('l', [0])
+        self._chord_pitches = array('h')
+        # Chord number by tuple of pitches, for the first
+        # _n_numbered_chords entries of the chord table
+        self._chord_numbers = {}
+        self._n_numbered_chords = 0
+        self._forget_tail()
+
+    def __repr__(self):
+        return '<music_tools.CompactInstrument: {}>'.format(self.name)
+
+    def __getstate__(self):
+        """Everything but the tail state, which is looked up again after
+        unpickling, as _UNKNOWN doesn't survive a round trip.
+
+        >>> import pickle
+        >>> part = CompactInstrument('violin')
+        >>> part.add_note(60, 1)
+        >>> part.add_note('rest', 2)
+        >>> copy = pickle.loads(pickle.dumps(part, pickle.HIGHEST_PROTOCOL))
+        >>> copy.get_last_pitched(), copy.beats_since_last_rest(2)
+        (<Note - pitch: 60 duration: 1>, 2.0)
+
+        """
+        state = self.__dict__.copy()
+        del state['_last_pitched']
+        del state['_last_rests']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._forget_tail()
+
+    def _encode_pitch(self, pitch):
+        if pitch == 'rest':
+            return REST_CODE
+        if pitch is None:
+            return NONE_CODE
+        if isinstance(pitch, list):
+            return CHORD_CODE - self._chord_number(pitch)
+        return pitch
+
+    def _chord_number(self, pitches):
+        """The chord table entry for `pitches`, added if it isn't there."""
+        chord_numbers = self._chord_numbers
+        offsets = self._chord_offsets
+        # Number entries put in the table some other way, such as by
+        # loading a snapshot
+        for chord_number in xrange(self._n_numbered_chords, len(offsets) - 1):
+            key = tuple(self._chord_pitches[offsets[chord_number]:offsets[chord_number + 1]])
+            chord_numbers.setdefault(key, chord_number)
+        key = tuple(pitches)
+        chord_number = chord_numbers.get(key)
+        if chord_number is None:
+            chord_number = chord_numbers[key] = len(offsets) - 1
+            self._chord_pitches.extend(pitches)
+            offsets.append(len(self._chord_pitches))
+        self._n_numbered_chords = len(offsets) - 1
+        return chord_number
+
+    def _decode_pitch(self, code):
+        if code >= 0:
+            return code
+        if code == REST_CODE:
+            return 'rest'
+        if code == NONE_CODE:
+            return None
+        chord_number = CHORD_CODE - code
+        start, end = self._chord_offsets[chord_number], self._chord_offsets[chord_number + 1]
+        return self._chord_pitches[start:end].tolist()
+
+    def _is_pitched_code(self, code):
+        if code >= 0:
+            return True
+        if code > CHORD_CODE:
+            return False
+        chord_number = CHORD_CODE - code
+        return self._chord_offsets[chord_number + 1] > self._chord_offsets[chord_number]
+
+    def _set_duration(self, index, ticks):
+        change = ticks - self._durations[index]
+        self._durations[index] = ticks
+        ends = self._ends
+        for i in xrange(index, len(ends)):
+            ends[i] += change
+        if self._pitches[index] == REST_CODE:
+            self._forget_tail()
+
+    def _forget_tail(self):
+        self._last_pitched = _UNKNOWN
+        self._last_rests = {}
+
+    def __len__(self):
+        return len(self._pitches)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [CompactNote(self, i) for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('CompactInstrument index out of range')
+        return CompactNote(self, index)
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield CompactNote(self, index)
+
+    def __reversed__(self):
+        for index in xrange(len(self) - 1, -1, -1):
+            yield CompactNote(self, index)
+
+    def append(self, note):
+        self.add_note(note.pitch, note.duration)
+
+    def extend(self, notes):
+        for note in notes:
+            self.add_note(note.pitch, note.duration)
+
+    def add_note(self, pitch=None, duration=0.0):
+        code = self._encode_pitch(pitch)
+        ticks = beats_to_ticks(duration)
+        index = len(self._pitches)
+        self._pitches.append(code)
+        self._durations.append(ticks)
+        self._ends.append((self._ends[-1] if self._ends else 0) + ticks)
+
+        if self._is_pitched_code(code):
+            self._last_pitched = index
+        elif code == REST_CODE:
+            for threshold in self._last_rests:
+                if ticks >= threshold * TICKS_PER_BEAT:
+                    self._last_rests[threshold] = index
+
+    def _update_index(self):
+        return self._ends
+
+    def duration(self):
+        if not self._ends:
+            return 0
+        return ticks_to_beats(self._ends[-1])
+
+    def get_tick(self):
+        return Tick(self.duration())
+
+    def get_at_tick(self, tick):
+        index = bisect_right(self._ends, tick * TICKS_PER_BEAT)
+        if index == len(self._ends):
+            return
+        start = self._ends[index - 1] if index else 0
+        if start <= tick * TICKS_PER_BEAT:
+            return CompactNote(self, index)
+
+    def _last_rest_index(self, rest_duration):
+        index = self._last_rests.get(rest_duration, _UNKNOWN)
+        if index is _UNKNOWN:
+            index = None
+            threshold = rest_duration * TICKS_PER_BEAT
+            for i in xrange(len(self) - 1, -1, -1):
+                if self._pitches[i] == REST_CODE and self._durations[i] >= threshold:
+                    index = i
+                    break
+            self._last_rests[rest_duration] = index
+        return index
+
+    def beats_since_last_rest(self, rest_duration=1):
+        index = self._last_rest_index(rest_duration)
+        if not self._ends:
+            return 0.0
+        start = self._ends[index - 1] if index else 0
+        return float(ticks_to_beats(self._ends[-1] - start))
 
     def get_last_pitched(self):
-        for note in reversed(self):
-            # Check if it's a note with a pitch (that can be 0, or a non-empty chord)
-            if isinstance(note.pitch, int) or (isinstance(note.pitch, list) and note.pitch):
-                return note
+        if self._last_pitched is _UNKNOWN:
+            self._last_pitched = None
+            for i in xrange(len(self) - 1, -1, -1):
+                if self._is_pitched_code(self._pitches[i]):
+                    self._last_pitched = i
+                    break
+        if self._last_pitched is not None:
+            return CompactNote(self, self._last_pitched)
+
+
+def _note_boundaries(instrument, part_index):
+    """Yield (tick, part_index, note) where each note starts, then
+    (tick, part_index, None) where the part ends, in whole ticks."""
+    start = 0
+    for note, end in itertools.izip(instrument, instrument._update_index()):
+        if end > start:
+            yield start, part_index, note
+        start = end
+    yield start, part_index, None
+
+
+def _group_boundaries(boundaries, n_parts):
+    """Fold merged boundaries into (tick, end, sounding) states, one for
+    each stretch of time where no part changes."""
+    sounding = [None] * n_parts
+    offset = None
+    for boundary_offset, part_index, note in boundaries:
+        if boundary_offset != offset:
+            if offset is not None:
+                yield offset, boundary_offset, tuple(sounding)
+            offset = boundary_offset
+        sounding[part_index] = note
+
+
+def sweep_ticks(instruments):
+    """Like sweep(), but with times in whole ticks (see TICKS_PER_BEAT)."""
+    boundaries = heapq.merge(*[_note_boundaries(i, n) for n, i in enumerate(instruments)])
+    return _group_boundaries(boundaries, len(instruments))
+
+
+def sweep(instruments):
+    """Yield (tick, end, sounding) for each stretch of time in which no
+    part changes. `sounding` holds the Note, or None, in each instrument.
+
+    """
+    for tick, end, sounding in sweep_ticks(instruments):
+        yield ticks_to_beats(tick), ticks_to_beats(end), sounding
+
+
+def _resample(states, n_ticks, resolution, n_parts):
+    silence = (None, ) * n_parts
+    step = beats_to_ticks(resolution)
+    states = iter(states)
+    state = next(states, None)
+    for n in xrange(n_ticks):
+        tick = n * step
+        while state is not None and state[1] <= tick:
+            state = next(states, None)
+        if state is not None and state[0] <= tick:
+            sounding = state[2]
+        else:
+            sounding = silence
+        yield n * resolution, (n + 1) * resolution, sounding
 
 
 class Music(object):
-    def __init__(self, title='Full Movie', starting_tempo_bpm=160, instrument_names=None):
+    def __init__(self, title='Full Movie', starting_tempo_bpm=160, instrument_names=None, compact=False):
         if instrument_names == None:
             instrument_names = (
                 'violin',
@@ -200,6 +903,9 @@ class Music(object):
             )
         self.instrument_names = instrument_names
 
+        # Store parts as typed arrays instead of lists of Notes
+        self.compact = compact
+
         self.title = title
         self.composer = 'Jonathan Marmor'
         self.time_signature = None
@@ -209,12 +915,14 @@ class Music(object):
         self._setup_parts()
 
 
-    def _setup_parts(self):
+    def _setup_parts(self, instrument_class=None):
         # Instantiate instruments/parts and make them accessible via Music
         self.instruments = []
         self.grid = {}
+        if instrument_class is None:
+            instrument_class = CompactInstrument if self.compact else Instrument
         for inst_name in self.instrument_names:
-            instrument = Instrument(inst_name)
+            instrument = instrument_class(inst_name)
             setattr(self, instrument.name, instrument)
             setattr(self, instrument.abbreviation, instrument)
             self.instruments.append(instrument)
@@ -260,11 +968,38 @@ class Music(object):
             result[instrument.name] = instrument.get_at_tick(tick)
         return result
 
+    def events(self, instruments=None, resolution=None):
+        """Yield what every part is playing each time any part changes.
+
+        Each record is a dict like get_at_tick() returns, plus the 'end' of
+        the stretch it covers. All parts are swept once in a heap merge of
+        their note boundaries, so sub-beat events like triplets are never
+        missed.
+
+        With `resolution`, resample onto a fixed grid instead: one record
+        every `resolution` beats, like iterating over Music does.
+
+        """
+        if instruments == None:
+            instruments = self.instruments
+        names = [i.name for i in instruments]
+
+        if resolution:
+            n_ticks = int(self.duration() / resolution)
+            states = _resample(sweep_ticks(instruments), n_ticks, resolution, len(instruments))
+        else:
+            states = sweep(instruments)
+
+        for tick, end, sounding in states:
+            result = dict(zip(names, sounding))
+            result['tick'] = tick
+            result['end'] = end
+            yield result
+
     def __iter__(self):
-        for tick in range(int(self.duration())):
-            yield self.get_at_tick(tick)
+        return self.events(resolution=1)
 
-    def print_columns(self):
+    def print_columns(self, resolution=1):
         print
         print self.title, 'by', self.composer
         instrument_names = [i.name for i in self.instruments]
@@ -273,7 +1008,7 @@ class Music(object):
             header += '{:<16}'.format(name)
         print header
 
-        for notes in self:
+        for notes in self.events(resolution=resolution):
             row = '{:<16}'.format(notes['tick'])
             for name in instrument_names:
                 if notes[name] == None:
@@ -295,7 +1030,10 @@ class Music(object):
 
         return result
 
-    def notate(self):
+    def notate(self, show=True, musicxml_path=None, midi_path=None, exporter=None):
+        """Build a music21 score of the music, then write it to
+        `musicxml_path`/`midi_path`, on `exporter`'s thread if given, and
+        open it in the notation app if `show`."""
         self.notation = Notation(
             instrument_names=self.instrument_names,
             title=self.title,
@@ -307,7 +1045,34 @@ class Music(object):
 
         for instrument in self.instruments:
             notation_instrument = self.notation.instruments_by_name[instrument.name]
-            for note in instrument:
-                notation_instrument.add_note(note.pitch, note.duration)
+            notation_instrument.add_notes((note.pitch, note.duration) for note in instrument)
+
+        if exporter:
+            exporter.export(self.notation, musicxml_path, midi_path)
+        elif musicxml_path or midi_path:
+            self.notation.export(musicxml_path, midi_path)
+        if show:
+            self.notation.show()
+
+
+profiling.register(Music, 'notate')
+
 
-        self.notation.show()
+def export_scores(musics, directory, musicxml=True, midi=True, background=False):
+    """Notate each Music and write it to `directory` as MusicXML and/or
+    MIDI, all in this process, without opening a notation app. With
+    `background`, files are written on a worker thread while the next
+    score is built. Files are named by number and title, made safe with
+    utils.slugify. Returns the paths written."""
+    exporter = BackgroundExporter() if background else None
+    paths = []
+    for n, music in enumerate(musics):
+        base = os.path.join(directory, '{:03d} - {}'.format(n, utils.slugify(music.title)))
+        musicxml_path = base + '.xml' if musicxml else None
+        midi_path = base + '.mid' if midi else None
+        music.notate(show=False, musicxml_path=musicxml_path, midi_path=midi_path, exporter=exporter)
+        if not background:
+            paths.extend(p for p in (musicxml_path, midi_path) if p)
+    if background:
+        paths = exporter.join()
+    return paths
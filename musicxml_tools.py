@@ -0,0 +1,326 @@
+"""Write MusicXML straight from a music_tools.Music, without music21.
+
+Each part is written a measure at a time as its notes are walked, so
+memory doesn't grow with the length of the piece. Notes are split at
+barlines and tied, durations are spelled from a table of note values,
+dots and tuplets, and pitches from a table of spellings.
+
+"""
+import datetime
+from xml.sax.saxutils import escape
+
+from music_tools import TICKS_PER_BEAT, beats_to_ticks
+
+
+# Divisions per quarter note. Music durations are in quarter notes.
+DIVISIONS = TICKS_PER_BEAT
+
+NOTE_VALUES = [
+    (TICKS_PER_BEAT * 4, 'whole'),
+    (TICKS_PER_BEAT * 2, 'half'),
+    (TICKS_PER_BEAT, 'quarter'),
+    (TICKS_PER_BEAT / 2, 'eighth'),
+    (TICKS_PER_BEAT / 4, '16th'),
+    (TICKS_PER_BEAT / 8, '32nd'),
+]
+
+# (actual, normal): 3 in the time of 2, etc.
+TUPLETS = [(3, 2), (5, 4), (7, 4)]
+
+# The same spellings music21 picks for MIDI pitch numbers
+SPELLINGS = [
+    ('C', 0), ('C', 1), ('D', 0), ('E', -1), ('E', 0), ('F', 0),
+    ('F', 1), ('G', 0), ('G', 1), ('A', 0), ('B', -1), ('B', 0)
+]
+
+# Clef sign and line by instrument, treble if not listed
+CLEFS = {
+    'bass': ('F', 4),
+}
+
+
+def _make_duration_shapes():
+    """Map a length in ticks to the (type, dots, tuplet) that notates it
+    as a single note. Plain and dotted values win over tuplets."""
+    shapes = {}
+    for ticks, note_type in NOTE_VALUES:
+        shapes[ticks] = (note_type, 0, None)
+        if ticks % 2 == 0:
+            shapes.setdefault(ticks * 3 / 2, (note_type, 1, None))
+        if ticks % 4 == 0:
+            shapes.setdefault(ticks * 7 / 4, (note_type, 2, None))
+    for ticks, note_type in NOTE_VALUES:
+        for actual, normal in TUPLETS:
+            if ticks * normal % actual == 0:
+                shapes.setdefault(ticks * normal / actual, (note_type, 0, (actual, normal)))
+    return shapes
+
+
+DURATION_SHAPES = _make_duration_shapes()
+SHAPE_LENGTHS = sorted(DURATION_SHAPES, reverse=True)
+
+# For each length in ticks up to the longest split so far, the fewest
+# pieces it splits into, the fewest of those that are tuplets, and the
+# first piece, or None if it can't be split
+_splits = [(0, 0, None)]
+
+_spelled_durations = {}
+
+
+def _extend_splits(ticks):
+    for remaining in xrange(len(_splits), ticks + 1):
+        best = None
+        for length in SHAPE_LENGTHS:
+            if length > remaining or _splits[remaining - length] is None:
+                continue
+            n_pieces, n_tuplets, _ = _splits[remaining - length]
+            cost = (n_pieces + 1, n_tuplets + (DURATION_SHAPES[length][2] is not None))
+            # Ties go to the longest first piece
+            if best is None or cost < best[:2]:
+                best = cost + (length,)
+        _splits.append(best)
+
+
+def spell_duration(ticks):
+    """Split a length in ticks into a list of (ticks, type, dots, tuplet)
+    pieces, to be tied together, each notatable as one note.
+
+    The split has as few pieces as possible, then as few tuplet pieces,
+    with plain pieces first and tuplet pieces grouped by ratio, longest
+    first. A length that isn't one note value can end in tuplet pieces
+    that don't fill out a group, e.g. 1 1/6 beats is a quarter tied to a
+    triplet 16th. Such pieces get a bracket of their own (see
+    _tuplet_brackets), as nothing else shares their group.
+
+    >>> [(t, note_type, tuplet) for t, note_type, _, tuplet in spell_duration(TICKS_PER_BEAT * 7 / 6)]
+    [(840, 'quarter', None), (140, '16th', (3, 2))]
+    >>> for sevenths in [1, 3, 5, 6]:
+    ...     print [(t, note_type, tuplet) for t, note_type, _, tuplet in spell_duration(TICKS_PER_BEAT * sevenths / 7)]
+    [(120, '16th', (7, 4))]
+    [(240, 'eighth', (7, 4)), (120, '16th', (7, 4))]
+    [(480, 'quarter', (7, 4)), (120, '16th', (7, 4))]
+    [(480, 'quarter', (7, 4)), (240, 'eighth', (7, 4))]
+
+    The rest of a 4/4 bar after a quintuplet 16th:
+
+    >>> sum(t for t, _, _, _ in spell_duration(TICKS_PER_BEAT * 4 - TICKS_PER_BEAT / 5))
+    3192
+
+    """
+    pieces = _spelled_durations.get(ticks)
+    if pieces is None:
+        _extend_splits(ticks)
+        if _splits[ticks] is None:
+            raise ValueError('Can\'t notate a duration of {} ticks'.format(ticks))
+        pieces = []
+        remaining = ticks
+        while remaining:
+            length = _splits[remaining][2]
+            note_type, dots, tuplet = DURATION_SHAPES[length]
+            pieces.append((length, note_type, dots, tuplet))
+            remaining -= length
+        pieces.sort(key=lambda piece: (piece[3] is not None, piece[3], -piece[0]))
+        _spelled_durations[ticks] = pieces
+    return pieces
+
+
+_pitch_elements = {}
+
+
+def pitch_element(pitch_number):
+    element = _pitch_elements.get(pitch_number)
+    if element is None:
+        octave, pitchclass = divmod(pitch_number, 12)
+        step, alter = SPELLINGS[pitchclass]
+        alter_element = '<alter>{}</alter>'.format(alter) if alter else ''
+        element = '<pitch><step>{}</step>{}<octave>{}</octave></pitch>'.format(step, alter_element, octave - 1)
+        _pitch_elements[pitch_number] = element
+    return element
+
+
+def _note_pieces(pitch, ticks, tie_stop, tie_start):
+    """(pitch, length, type, dots, tuplet, tie stop, tie start) for each
+    notatable piece of one note, or of the part of it between barlines."""
+    if pitch is None or pitch == []:
+        pitch = 'rest'
+    tied = pitch != 'rest'
+    pieces = spell_duration(ticks)
+    return [
+        (pitch, length, note_type, dots, tuplet,
+         tied and (tie_stop or n > 0), tied and (tie_start or n < len(pieces) - 1))
+        for n, (length, note_type, dots, tuplet) in enumerate(pieces)
+    ]
+
+
+def _tuplet_brackets(pieces):
+    """Whether each piece starts and stops a tuplet bracket.
+
+    A bracket covers a run of consecutive pieces with the same tuplet
+    ratio, closing early each time the run adds up to a whole number of
+    beats, so three triplet eighths, or a triplet quarter and eighth, get
+    a bracket each.
+
+    """
+    brackets = []
+    open_ratio = None
+    run_ticks = 0
+    for n, piece in enumerate(pieces):
+        length, tuplet = piece[1], piece[4]
+        start = stop = False
+        if tuplet:
+            if open_ratio != tuplet:
+                start = True
+                open_ratio = tuplet
+                run_ticks = 0
+            run_ticks += length
+            next_tuplet = pieces[n + 1][4] if n + 1 < len(pieces) else None
+            if run_ticks % TICKS_PER_BEAT == 0 or next_tuplet != tuplet:
+                stop = True
+                open_ratio = None
+        else:
+            open_ratio = None
+        brackets.append((start, stop))
+    return brackets
+
+
+def _measure_elements(pieces):
+    """MusicXML <note>s for a measure's pieces."""
+    elements = []
+    for (pitch, length, note_type, dots, tuplet, tie_stop, tie_start), (bracket_start, bracket_stop) in zip(
+            pieces, _tuplet_brackets(pieces)):
+        if pitch == 'rest':
+            pitch_elements = ['<rest/>']
+        elif isinstance(pitch, list):
+            pitch_elements = [pitch_element(p) for p in pitch]
+        else:
+            pitch_elements = [pitch_element(pitch)]
+
+        ties = ''
+        tied = ''
+        if tie_stop:
+            ties += '<tie type="stop"/>'
+            tied += '<tied type="stop"/>'
+        if tie_start:
+            ties += '<tie type="start"/>'
+            tied += '<tied type="start"/>'
+        tuplet_notations = ''
+        if bracket_start:
+            tuplet_notations += '<tuplet type="start" bracket="yes"/>'
+        if bracket_stop:
+            tuplet_notations += '<tuplet type="stop"/>'
+        time_modification = ''
+        if tuplet:
+            time_modification = (
+                '<time-modification><actual-notes>{}</actual-notes>'
+                '<normal-notes>{}</normal-notes></time-modification>'
+            ).format(*tuplet)
+
+        for i, pitch_xml in enumerate(pitch_elements):
+            # Brackets go on the first note of a chord
+            notations = tied + ('' if i else tuplet_notations)
+            if notations:
+                notations = '<notations>{}</notations>'.format(notations)
+            elements.append('<note>{}{}<duration>{}</duration>{}<voice>1</voice><type>{}</type>{}{}{}</note>'.format(
+                '<chord/>' if i else '',
+                pitch_xml,
+                length,
+                ties,
+                note_type,
+                '<dot/>' * dots,
+                time_modification,
+                notations
+            ))
+    return elements
+
+
+def _parse_time_signature(time_signature):
+    """(beats, beat_type), 4/4 if there isn't one, like music21."""
+    if not time_signature:
+        return 4, 4
+    beats, beat_type = time_signature.split('/')
+    return int(beats), int(beat_type)
+
+
+def _tempo_direction(bpm, quarter_duration):
+    note_type, dots, tuplet = DURATION_SHAPES[beats_to_ticks(quarter_duration)]
+    return (
+        '<direction placement="above"><direction-type><metronome>'
+        '<beat-unit>{}</beat-unit>{}<per-minute>{}</per-minute>'
+        '</metronome></direction-type><sound tempo="{}"/></direction>'
+    ).format(note_type, '<beat-unit-dot/>' * dots, bpm, bpm * quarter_duration)
+
+
+def _part_measures(instrument, measure_ticks, n_measures):
+    """Yield the list of <note>s in each measure of a part, filling out
+    the last measure and any missing ones up to `n_measures` with rests."""
+    measure = []
+    position = 0
+    for note in instrument:
+        pitch = note.pitch
+        ticks = beats_to_ticks(note.duration)
+        tie_stop = False
+        while ticks:
+            piece = min(ticks, measure_ticks - position)
+            ticks -= piece
+            measure.extend(_note_pieces(pitch, piece, tie_stop, ticks > 0))
+            tie_stop = True
+            position += piece
+            if position == measure_ticks:
+                yield _measure_elements(measure)
+                n_measures -= 1
+                measure = []
+                position = 0
+
+    if position:
+        measure.extend(_note_pieces('rest', measure_ticks - position, False, False))
+        yield _measure_elements(measure)
+        n_measures -= 1
+    for _ in xrange(n_measures):
+        yield _measure_elements(_note_pieces('rest', measure_ticks, False, False))
+
+
+def write_musicxml(music, destination):
+    """Write `music` as a MusicXML score to `destination`, a path or a
+    file-like object."""
+    if isinstance(destination, basestring):
+        with open(destination, 'w') as f:
+            return write_musicxml(music, f)
+    write = destination.write
+
+    beats, beat_type = _parse_time_signature(music.time_signature)
+    measure_ticks = beats * TICKS_PER_BEAT * 4 / beat_type
+    total_ticks = beats_to_ticks(music.duration())
+    n_measures = max(1, -(-total_ticks // measure_ticks))
+
+    write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    write('<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 3.0 Partwise//EN" '
+          '"http://www.musicxml.org/dtds/partwise.dtd">\n')
+    write('<score-partwise version="3.0">\n')
+    write('<movement-title>{}</movement-title>\n'.format(escape(music.title)))
+    write('<identification><creator type="composer">{}</creator>'.format(escape(music.composer)))
+    write('<encoding><encoding-date>{}</encoding-date></encoding></identification>\n'.format(
+        datetime.datetime.utcnow().strftime('%Y-%m-%d')))
+
+    write('<part-list>\n')
+    for n, instrument in enumerate(music.instruments, 1):
+        write('<score-part id="P{}"><part-name>{}</part-name><part-abbreviation>{}</part-abbreviation></score-part>\n'.format(
+            n, escape(instrument.name.replace('_', ' ').title()), escape(instrument.abbreviation)))
+    write('</part-list>\n')
+
+    tempo = _tempo_direction(music.starting_tempo_bpm, music.starting_tempo_quarter_duration)
+    for n, instrument in enumerate(music.instruments, 1):
+        write('<part id="P{}">\n'.format(n))
+        clef_sign, clef_line = CLEFS.get(instrument.name, ('G', 2))
+        for number, notes in enumerate(_part_measures(instrument, measure_ticks, n_measures), 1):
+            write('<measure number="{}">'.format(number))
+            if number == 1:
+                write((
+                    '<attributes><divisions>{}</divisions><key><fifths>0</fifths></key>'
+                    '<time><beats>{}</beats><beat-type>{}</beat-type></time>'
+                    '<clef><sign>{}</sign><line>{}</line></clef></attributes>'
+                ).format(DIVISIONS, beats, beat_type, clef_sign, clef_line))
+                write(tempo)
+            write(''.join(notes))
+            write('</measure>\n')
+        write('</part>\n')
+    write('</score-partwise>\n')
@@ -1,6 +1,14 @@
-import datetime
+"""Notation through music21.
+
+music21 takes seconds to import, so it is only imported by the functions
+that use it, the first time one of them is called. Runs that only
+generate or analyze music never load it.
 
-import music21
+"""
+import copy
+import datetime
+import threading
+import Queue
 
 
 # NOTATION_GUI_APPS = [
@@ -19,12 +27,64 @@ def show(stream):
     #     stream.show('musicxml', '/Applications/MuseScore 2.app')
 
 
+def export(stream, musicxml_path=None, midi_path=None):
+    """Write a stream to MusicXML and/or MIDI files without opening any
+    notation app. Returns the paths written."""
+    paths = []
+    if musicxml_path:
+        paths.append(stream.write('musicxml', fp=musicxml_path))
+    if midi_path:
+        paths.append(stream.write('midi', fp=midi_path))
+    return paths
+
+
+class BackgroundExporter(object):
+    """Export Notations on a worker thread while the caller carries on
+    generating. Call join() to wait for everything queued so far; the
+    worker then exits, and the next export() starts another."""
+    def __init__(self):
+        self.paths = []
+        self.errors = []
+        self._queue = Queue.Queue()
+        self._thread = None
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            notation, musicxml_path, midi_path = job
+            try:
+                self.paths.extend(notation.export(musicxml_path, midi_path))
+            except Exception as e:
+                self.errors.append(e)
+
+    def export(self, notation, musicxml_path=None, midi_path=None):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work)
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put((notation, musicxml_path, midi_path))
+
+    def join(self):
+        if self._thread is not None:
+            # Stop the worker once it has done everything before this
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self.errors:
+            raise self.errors[0]
+        return self.paths
+
+
 def get_music21_user_settings_path():
+    import music21
     user_settings = music21.environment.UserSettings()
     return user_settings.getSettingsPath()
 
 
 def print_music21_user_settings():
+    import music21
     for key in sorted(music21.environment.keys()):
         try:
             value = music21.environment.get(key)
@@ -33,15 +93,17 @@ def print_music21_user_settings():
         print '{:<25} {}'.format(key, value)
 
 
+# Classes are named rather than referenced so music21 isn't needed until
+# a score is made
 instrument_directory = {
-    'violin': {'class': music21.instrument.Violin, 'name': 'Violin', 'abbreviation': 'vln'},
-    'flute': {'class': music21.instrument.Flute, 'name': 'Flute', 'abbreviation': 'f'},
-    'oboe': {'class': music21.instrument.Oboe, 'name': 'Oboe', 'abbreviation': 'ob'},
-    'clarinet': {'class': music21.instrument.Clarinet, 'name': 'Clarinet', 'abbreviation': 'cl'},
-    'alto_saxophone': {'class': music21.instrument.Saxophone, 'name': 'Alto Saxophone', 'abbreviation': 'sx'},
-    'trumpet': {'class': music21.instrument.Trumpet, 'name': 'Trumpet', 'abbreviation': 'tpt'},
-    'bass': {'class': music21.instrument.Bass, 'name': 'Bass', 'abbreviation': 'b', 'clef': music21.clef.BassClef},
-    'percussion': {'class': music21.instrument.Percussion, 'name': 'Percussion', 'abbreviation': 'perc'}
+    'violin': {'class': 'Violin', 'name': 'Violin', 'abbreviation': 'vln'},
+    'flute': {'class': 'Flute', 'name': 'Flute', 'abbreviation': 'f'},
+    'oboe': {'class': 'Oboe', 'name': 'Oboe', 'abbreviation': 'ob'},
+    'clarinet': {'class': 'Clarinet', 'name': 'Clarinet', 'abbreviation': 'cl'},
+    'alto_saxophone': {'class': 'Saxophone', 'name': 'Alto Saxophone', 'abbreviation': 'sx'},
+    'trumpet': {'class': 'Trumpet', 'name': 'Trumpet', 'abbreviation': 'tpt'},
+    'bass': {'class': 'Bass', 'name': 'Bass', 'abbreviation': 'b', 'clef': 'BassClef'},
+    'percussion': {'class': 'Percussion', 'name': 'Percussion', 'abbreviation': 'perc'}
 }
 
 
@@ -74,6 +136,8 @@ def make_music21_score(
             starting_tempo_bpm=60,
             starting_tempo_quarter_duration=1.0
         ):
+    import music21
+
     timestamp = datetime.datetime.utcnow()
     metadata = music21.metadata.Metadata()
     metadata.title = title
@@ -100,7 +164,7 @@ def make_music21_score(
             music21_time_signature = music21.meter.TimeSignature(time_signature)
             part.append(music21_time_signature)
 
-        m21_instrument = instrument['class']()
+        m21_instrument = getattr(music21.instrument, instrument['class'])()
         m21_instrument.partName = instrument['name']
         m21_instrument.partAbbreviation = instrument['abbreviation']
 
@@ -108,7 +172,7 @@ def make_music21_score(
 
         clef = instrument.get('clef')
         if clef:
-            part.append(clef())
+            part.append(getattr(music21.clef, clef)())
 
         parts.append(part)  # Unnecessary?
         score.insert(0, part)
@@ -116,24 +180,87 @@ def make_music21_score(
     return score
 
 
+# (step, accidental name or None, octave) by pitch number
+_pitch_spellings = {}
+
+# Prebuilt durations by quarter length, to copy from
+_duration_templates = {}
+
+# Whether this music21 has the private Stream and Duration internals the
+# fast paths below use, None until checked
+_private_api = None
+
+
+def has_private_api():
+    """Does this music21 have Stream._insertCore and Duration._components
+    and _tuplets? They are there in the pinned 2.0.10; other versions get
+    the slower public insert() and fresh Durations."""
+    global _private_api
+    if _private_api is None:
+        import music21
+        d = music21.duration.Duration(1.0)
+        _private_api = (
+            hasattr(music21.stream.Stream, '_insertCore') and
+            hasattr(music21.stream.Stream, 'elementsChanged') and
+            hasattr(d, '_components') and
+            hasattr(d, '_tuplets')
+        )
+    return _private_api
+
+
+def make_music21_pitch(pitch_number):
+    import music21
+
+    spelling = _pitch_spellings.get(pitch_number)
+    if spelling is None:
+        p = music21.pitch.Pitch(pitch_number)
+        accidental = p.accidental.name
+        if accidental == 'natural':
+            accidental = None
+        spelling = _pitch_spellings[pitch_number] = (p.step, accidental, p.octave)
+
+    step, accidental, octave = spelling
+    p = music21.pitch.Pitch()
+    p.step = step
+    if accidental:
+        p.accidental = music21.pitch.Accidental(accidental)
+    p.octave = octave
+    return p
+
+
+def make_music21_duration(quarter_length):
+    import music21
+
+    if not has_private_api():
+        return music21.duration.Duration(quarter_length)
+
+    template = _duration_templates.get(quarter_length)
+    if template is None:
+        template = music21.duration.Duration()
+        template.quarterLength = quarter_length
+        # Work out the note type, dots and tuplets once, here
+        template.type
+        _duration_templates[quarter_length] = template
+
+    # Durations are mutable, so each note gets its own copy, with its own
+    # component list and tuplets
+    d = copy.copy(template)
+    d._components = list(template._components)
+    if template._tuplets:
+        d._tuplets = tuple(copy.deepcopy(t) for t in template._tuplets)
+    return d
+
+
 def make_music21_note(pitch_number=None, duration=1.0):
+    import music21
+
+    d = make_music21_duration(duration)
     if pitch_number == None or pitch_number == 'rest':
-        n = music21.note.Rest()
+        n = music21.note.Rest(duration=d)
     elif isinstance(pitch_number, list):
-        pitches = [music21.pitch.Pitch(p) for p in pitch_number]
-        for p in pitches:
-            if p.accidental.name is 'natural':
-                p.accidental = None
-        n = music21.chord.Chord(pitches)
+        n = music21.chord.Chord([make_music21_pitch(p) for p in pitch_number], duration=d)
     else:
-        p = music21.pitch.Pitch(pitch_number)
-        if p.accidental.name is 'natural':
-            p.accidental = None
-        n = music21.note.Note(p)
-
-    d = music21.duration.Duration()
-    d.quarterLength = duration
-    n.duration = d
+        n = music21.note.Note(make_music21_pitch(pitch_number), duration=d)
 
     return n
 
@@ -146,9 +273,36 @@ class Instrument(object):
 
         self.range = instrument_ranges[self.name]
 
+        # Where the next note goes. Kept here rather than asking the part
+        # for its highestTime, which is recomputed after every change.
+        self._offset = music21_part.highestTime
+
     def add_note(self, pitch=None, duration=None):
-        m21_note = make_music21_note(pitch, duration)
-        self._music21_part.append(m21_note)
+        self.add_notes([(pitch, duration)])
+
+    def add_notes(self, notes):
+        """Add (pitch, duration)s one after another. They go into the part
+        at precomputed offsets in one bulk insert, so filling a part takes
+        time linear in the number of notes."""
+        import music21
+
+        part = self._music21_part
+        offset = self._offset
+        if has_private_api():
+            # The public insert() re-sorts the part and clears its caches
+            # every time, which makes filling a part quadratic. Append
+            # unsorted in offset order instead, and tell the part once.
+            for pitch, duration in notes:
+                m21_note = make_music21_note(pitch, duration)
+                part._insertCore(offset, m21_note, ignoreSort=True)
+                offset = music21.common.opFrac(offset + m21_note.duration.quarterLength)
+            part.elementsChanged()
+        else:
+            for pitch, duration in notes:
+                m21_note = make_music21_note(pitch, duration)
+                part.insert(offset, m21_note)
+                offset = offset + m21_note.duration.quarterLength
+        self._offset = offset
 
 
 class Notation(object):
@@ -162,6 +316,7 @@ class Notation(object):
             starting_tempo_bpm=60,
             starting_tempo_quarter_duration=1.0
         ):
+        import music21
 
         # Set up temp file directory
         music21.environment.set('directoryScratch', 'output/tmp')
@@ -189,3 +344,6 @@ class Notation(object):
 
     def show(self):
         show(self._score)
+
+    def export(self, musicxml_path=None, midi_path=None):
+        return export(self._score, musicxml_path, midi_path)
@@ -0,0 +1,158 @@
+"""Per-phase call counts, timers and allocations for the generators.
+
+Modules register the methods that mark their phases with register().
+Until enable() is called that costs nothing: the methods are left
+untouched. enable() swaps in wrappers that count calls and time them,
+and can also run cProfile and, where the tracemalloc module is available,
+track memory allocated in each phase. disable() puts the originals back.
+
+Times are inclusive: a phase called from another phase counts toward
+both. Phases run in worker processes aren't counted.
+
+"""
+import time
+import cProfile
+import pstats
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class PhaseTimer(object):
+    def __init__(self, label):
+        self.label = label
+        self.calls = 0
+        self.seconds = 0.0
+        self.allocated = 0
+
+    def wrap(self, function, trace_memory=False):
+        timer = self
+
+        if trace_memory:
+            def wrapper(*args, **kwargs):
+                timer.calls += 1
+                before = tracemalloc.get_traced_memory()[0]
+                start = time.time()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    timer.seconds += time.time() - start
+                    timer.allocated += tracemalloc.get_traced_memory()[0] - before
+        else:
+            def wrapper(*args, **kwargs):
+                timer.calls += 1
+                start = time.time()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    timer.seconds += time.time() - start
+
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+
+
+# (owner, attribute name, original function) for each registered phase
+_phases = []
+
+# PhaseTimer by label
+timers = {}
+
+enabled = False
+profiler = None
+
+
+def _label(owner, name):
+    # Classes are qualified by module; music_tools and full_movie both
+    # have a Music
+    module = getattr(owner, '__module__', '__main__')
+    if module == '__main__':
+        return '{}.{}'.format(owner.__name__, name)
+    return '{}.{}.{}'.format(module, owner.__name__, name)
+
+
+def get_timer(label):
+    timer = timers.get(label)
+    if timer is None:
+        timer = timers[label] = PhaseTimer(label)
+    return timer
+
+
+def register(owner, *names):
+    """Mark methods of a class, or functions of a module, as phases."""
+    for name in names:
+        _phases.append((owner, name, owner.__dict__[name]))
+        if enabled:
+            _instrument(owner, name, owner.__dict__[name])
+
+
+def _instrument(owner, name, function):
+    timer = get_timer(_label(owner, name))
+    setattr(owner, name, timer.wrap(function, trace_memory=tracemalloc is not None and tracemalloc.is_tracing()))
+
+
+def enable(profile=False, trace_memory=False):
+    """Start timing every registered phase. With `profile`, also run
+    cProfile; with `trace_memory`, also count bytes allocated per phase,
+    if tracemalloc is available."""
+    global enabled, profiler
+    if enabled:
+        disable()
+    if trace_memory and tracemalloc is not None and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    for owner, name, function in _phases:
+        _instrument(owner, name, function)
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    enabled = True
+
+
+def disable():
+    """Put the original methods back and stop profiling. Counts so far
+    are kept until reset()."""
+    global enabled
+    for owner, name, function in _phases:
+        setattr(owner, name, function)
+    if profiler is not None:
+        profiler.disable()
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    enabled = False
+
+
+def reset():
+    """Zero every phase's counts. Installed wrappers keep their timers."""
+    for timer in timers.values():
+        timer.calls = 0
+        timer.seconds = 0.0
+        timer.allocated = 0
+
+
+def report():
+    """(label, calls, seconds, bytes allocated or None) for each phase
+    that ran, slowest first."""
+    rows = []
+    for timer in timers.values():
+        if timer.calls:
+            allocated = timer.allocated if tracemalloc is not None and timer.allocated else None
+            rows.append((timer.label, timer.calls, timer.seconds, allocated))
+    rows.sort(key=lambda row: row[2], reverse=True)
+    return rows
+
+
+def print_report(n_profile_lines=20):
+    print
+    print '-' * 10, 'PHASES', '-' * 10
+    print '{:<48} {:>10} {:>12} {:>14}'.format('phase', 'calls', 'seconds', 'allocated')
+    for label, calls, seconds, allocated in report():
+        print '{:<48} {:>10} {:>12.4f} {:>14}'.format(label, calls, seconds, '' if allocated is None else allocated)
+    if profiler is not None:
+        print
+        # Taking the stats stops the profiler, so carry on afterwards
+        stats = pstats.Stats(profiler)
+        if enabled:
+            profiler.enable()
+        stats.sort_stats('cumulative').print_stats(n_profile_lines)
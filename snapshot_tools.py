@@ -0,0 +1,247 @@
+"""Save a music_tools.Music to a compact binary snapshot and load it back.
+
+A snapshot is MAGIC, a little-endian uint16 format version and uint32
+header length, a JSON header with the title, tempo, time signature and
+each part's name and sizes, then each part's columns: pitch codes
+(int32), durations and note ends (int32 ticks, see TICKS_PER_BEAT), and
+the chord table's offsets (int32) and pitches (int16). Pitch codes are
+CompactInstrument's. Columns start on 8-byte boundaries.
+
+read_snapshot() maps the file and gives parts that read a note from the
+mapped columns only when it's touched, so opening a long piece takes no
+time, and analysis can take whole columns with MappedColumn.array() or
+MappedColumn.numpy(). Mapped parts are read only; load with
+mapped=False to get parts that can be added to.
+
+"""
+import sys
+import json
+import mmap
+import struct
+from array import array
+
+from music_tools import Music, CompactInstrument, TICKS_PER_BEAT
+
+
+MAGIC = b'MUSICSNP'
+VERSION = 2
+
+# MAGIC, version, header length
+PREAMBLE = struct.Struct('<8sHI')
+
+ALIGNMENT = 8
+
+# Each part's columns in file order, with their array typecodes
+COLUMNS = [
+    ('pitches', 'i'),
+    ('durations', 'i'),
+    ('ends', 'i'),
+    ('chord_offsets', 'i'),
+    ('chord_pitches', 'h'),
+]
+
+BIG_ENDIAN = sys.byteorder == 'big'
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _little_endian_bytes(values, typecode):
+    values = array(typecode, values)
+    if BIG_ENDIAN:
+        values.byteswap()
+    return values.tostring()
+
+
+def _compact_part(instrument):
+    if isinstance(instrument, CompactInstrument):
+        return instrument
+    part = CompactInstrument(instrument.name)
+    part.extend(instrument)
+    return part
+
+
+def write_snapshot(music, destination):
+    """Write `music` as a snapshot to `destination`, a path or a file-like
+    object opened in binary mode."""
+    if isinstance(destination, basestring):
+        with open(destination, 'wb') as f:
+            return write_snapshot(music, f)
+
+    parts = []
+    part_headers = []
+    offset = 0
+    for instrument in music.instruments:
+        part = _compact_part(instrument)
+        columns = {
+            'pitches': part._pitches,
+            'durations': part._durations,
+            'ends': part._ends,
+            'chord_offsets': part._chord_offsets,
+            'chord_pitches': part._chord_pitches,
+        }
+        offsets = {}
+        for name, typecode in COLUMNS:
+            offsets[name] = offset
+            offset = _aligned(offset + len(columns[name]) * array(typecode).itemsize)
+        parts.append(columns)
+        part_headers.append({
+            'name': instrument.name,
+            'n_notes': len(part._pitches),
+            'n_chord_pitches': len(part._chord_pitches),
+            'n_chords': len(part._chord_offsets) - 1,
+            'offsets': offsets,
+        })
+
+    header = json.dumps({
+        'title': music.title,
+        'composer': music.composer,
+        'time_signature': music.time_signature,
+        'starting_tempo_bpm': music.starting_tempo_bpm,
+        'starting_tempo_quarter_duration': music.starting_tempo_quarter_duration,
+        'ticks_per_beat': TICKS_PER_BEAT,
+        'parts': part_headers,
+    }, sort_keys=True).encode('utf-8')
+
+    write = destination.write
+    write(PREAMBLE.pack(MAGIC, VERSION, len(header)))
+    write(header)
+    position = PREAMBLE.size + len(header)
+    data_start = _aligned(position)
+    write(b'\0' * (data_start - position))
+    position = 0
+    for columns, part_header in zip(parts, part_headers):
+        for name, typecode in COLUMNS:
+            write(b'\0' * (part_header['offsets'][name] - position))
+            data = _little_endian_bytes(columns[name], typecode)
+            write(data)
+            position = part_header['offsets'][name] + len(data)
+    write(b'\0' * (_aligned(position) - position))
+
+
+class MappedColumn(object):
+    """A read-only column of little-endian ints in a buffer, such as a
+    mapped snapshot. Items are unpacked as they're read."""
+    def __init__(self, buffer_, offset, typecode, length):
+        self._buffer = buffer_
+        self._offset = offset
+        self.typecode = typecode
+        self._length = length
+        self._struct = struct.Struct('<' + typecode)
+        self._itemsize = self._struct.size
+
+    def __repr__(self):
+        return '<snapshot_tools.MappedColumn: {} x {}>'.format(self._length, self.typecode)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step != 1:
+                return array(self.typecode, [self[i] for i in xrange(start, stop, step)])
+            return self.array(start, stop)
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('MappedColumn index out of range')
+        return self._struct.unpack_from(self._buffer, self._offset + index * self._itemsize)[0]
+
+    def __iter__(self):
+        return iter(self.array())
+
+    def array(self, start=0, stop=None):
+        """A copy of the column, or part of it, as an array."""
+        if stop is None:
+            stop = self._length
+        values = array(self.typecode)
+        if stop > start:
+            values.fromstring(self._buffer[self._offset + start * self._itemsize:self._offset + stop * self._itemsize])
+            if BIG_ENDIAN:
+                values.byteswap()
+        return values
+
+    def numpy(self):
+        """The column as a read-only numpy array over the buffer, without
+        copying."""
+        import numpy
+        return numpy.frombuffer(self._buffer, dtype='<' + self.typecode, count=self._length, offset=self._offset)
+
+
+class MappedInstrument(CompactInstrument):
+    """A CompactInstrument whose columns are MappedColumns of a snapshot.
+    Notes can be read but not added or changed."""
+    def __repr__(self):
+        return '<snapshot_tools.MappedInstrument: {}>'.format(self.name)
+
+    def _encode_pitch(self, pitch):
+        raise TypeError('Parts loaded from a mapped snapshot are read only')
+
+    def _set_duration(self, index, ticks):
+        raise TypeError('Parts loaded from a mapped snapshot are read only')
+
+
+def _read_header(buffer_):
+    magic, version, header_length = PREAMBLE.unpack_from(buffer_, 0)
+    if magic != MAGIC:
+        raise ValueError('Not a music snapshot')
+    if version != VERSION:
+        raise ValueError('Unsupported snapshot version {}, expected {}'.format(version, VERSION))
+    header = json.loads(buffer_[PREAMBLE.size:PREAMBLE.size + header_length].decode('utf-8'))
+    if header['ticks_per_beat'] != TICKS_PER_BEAT:
+        raise ValueError('Snapshot has {} ticks per beat, expected {}'.format(header['ticks_per_beat'], TICKS_PER_BEAT))
+    return header, _aligned(PREAMBLE.size + header_length)
+
+
+def _column_lengths(part_header):
+    n_notes = part_header['n_notes']
+    return {
+        'pitches': n_notes,
+        'durations': n_notes,
+        'ends': n_notes,
+        'chord_offsets': part_header['n_chords'] + 1,
+        'chord_pitches': part_header['n_chord_pitches'],
+    }
+
+
+def read_snapshot(path, mapped=True):
+    """Load a Music saved with write_snapshot().
+
+    With `mapped`, the file is memory-mapped and the parts are
+    MappedInstruments reading from it. Otherwise the columns are copied
+    into ordinary CompactInstruments, which can be added to.
+
+    """
+    with open(path, 'rb') as f:
+        if mapped:
+            buffer_ = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            buffer_ = f.read()
+    header, data_start = _read_header(buffer_)
+
+    music = Music(
+        title=header['title'],
+        starting_tempo_bpm=header['starting_tempo_bpm'],
+        instrument_names=tuple(str(part['name']) for part in header['parts']),
+        compact=True
+    )
+    music.composer = header['composer']
+    music.time_signature = header['time_signature']
+    music.starting_tempo_quarter_duration = header['starting_tempo_quarter_duration']
+    if mapped:
+        music._setup_parts(MappedInstrument)
+
+    for instrument, part_header in zip(music.instruments, header['parts']):
+        lengths = _column_lengths(part_header)
+        for name, typecode in COLUMNS:
+            offset = data_start + part_header['offsets'][name]
+            column = MappedColumn(buffer_, offset, typecode, lengths[name])
+            if not mapped:
+                column = column.array()
+                if name in ('durations', 'ends'):
+                    column = array('l', column)
+            setattr(instrument, '_' + name, column)
+        instrument._forget_tail()
+    return music
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""Grid or random search over Movement3's weighting constants.
+
+A point is a dict of movement3.DEFAULT_PARAMS overrides. Each point is
+generated with the same seeds, so points are compared on the same random
+draws, and each (point, seed, duration) is run once: its stats are cached
+on disk under a hash of all three, so a repeated or interrupted sweep only
+runs what's missing. Runs are spread over a process pool and points are
+ranked by an objective of their stats, the mean over seeds.
+
+Cached stats only depend on the point, the seed and the duration. Bump
+CACHE_VERSION after changing how Movement3 generates, or clear the cache.
+
+"""
+import os
+import json
+import random
+import pickle
+import hashlib
+import itertools
+import importlib
+import multiprocessing
+
+import movement3
+from candidates import score_stats
+from utils import derive_seed
+
+
+CACHE_VERSION = 2
+
+DEFAULT_CACHE_DIRECTORY = 'sweep_cache'
+
+
+def _normalized(value):
+    """`value` with every number a float and every sequence a list, so
+    equal points describe the same way.
+
+    >>> _normalized({'ascent_weight': 1, 'bass_durations': [((1, 2), (3, 1.5))]})
+    {'ascent_weight': 1.0, 'bass_durations': [[[1.0, 2.0], [3.0, 1.5]]]}
+
+    """
+    if isinstance(value, dict):
+        return dict((k, _normalized(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_normalized(v) for v in value]
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+
+def point_key(params, seed, duration):
+    """Hash of a point, with defaults filled in and numbers made floats, so
+    that leaving a parameter out and giving its default value, or giving 1
+    and 1.0, hit the same cache entry.
+
+    >>> point_key({'ascent_weight': 1}, 0, 30) == point_key({'ascent_weight': 1.0}, 0, 30.0)
+    True
+
+    """
+    params = _normalized(dict(movement3.DEFAULT_PARAMS, **params))
+    description = json.dumps([CACHE_VERSION, params, seed, float(duration)], sort_keys=True)
+    return hashlib.sha1(description).hexdigest()
+
+
+def _cache_path(cache_directory, key):
+    return os.path.join(cache_directory, key[:2], key + '.pickle')
+
+
+def load_cached(cache_directory, key):
+    """Cached stats for `key`, or None."""
+    try:
+        with open(_cache_path(cache_directory, key), 'rb') as f:
+            return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def save_cached(cache_directory, key, stats):
+    path = _cache_path(cache_directory, key)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another worker made it
+            pass
+    # Write then rename, so an interrupted sweep never leaves half a file
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary_path, 'wb') as f:
+        pickle.dump(stats, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(temporary_path, path)
+
+
+def grid(**values):
+    """A point for every combination of the given values.
+
+    >>> len(grid(harmony_weight=[.2, .33, .5], ascent_weight=[1.0, 1.5]))
+    6
+
+    """
+    names = sorted(values)
+    return [dict(zip(names, combination)) for combination in itertools.product(*[values[n] for n in names])]
+
+
+def random_points(n_points, ranges, seed=None):
+    """`n_points` points with each parameter uniform in its (low, high)
+    range, or a whole number if both ends are ints."""
+    rng = random.Random(seed)
+    points = []
+    for _ in range(n_points):
+        point = {}
+        for name in sorted(ranges):
+            low, high = ranges[name]
+            if isinstance(low, int) and isinstance(high, int):
+                point[name] = rng.randint(low, high)
+            else:
+                point[name] = rng.uniform(low, high)
+        points.append(point)
+    return points
+
+
+def _evaluate(job):
+    point_number, params, seed, duration, cache_directory, key = job
+    stats = movement3.generate(seed, duration, params).export_stats()
+    save_cached(cache_directory, key, stats)
+    return point_number, stats
+
+
+def sweep(points, n_seeds=4, seed=0, duration=30.0, objective=score_stats,
+          n_workers=None, cache_directory=DEFAULT_CACHE_DIRECTORY):
+    """Rank `points` by the mean of `objective` over their runs, best first.
+
+    Returns a list of (mean objective, point, number of runs generated now
+    rather than read from the cache). `objective` takes a run's exported
+    stats (see Movement3.export_stats) and is only called in this process,
+    so it can be any function. `n_workers` defaults to one per CPU.
+
+    """
+    seeds = [derive_seed('sweep', seed, n) for n in range(n_seeds)]
+    totals = [0.0] * len(points)
+    generated = [0] * len(points)
+
+    jobs = []
+    for point_number, params in enumerate(points):
+        for run_seed in seeds:
+            key = point_key(params, run_seed, duration)
+            stats = load_cached(cache_directory, key)
+            if stats is None:
+                jobs.append((point_number, params, run_seed, duration, cache_directory, key))
+            else:
+                totals[point_number] += objective(stats)
+    print '{} runs cached, {} to generate'.format(len(points) * n_seeds - len(jobs), len(jobs))
+
+    pool = None
+    if n_workers != 1 and jobs:
+        pool = multiprocessing.Pool(n_workers)
+        results = pool.imap_unordered(_evaluate, jobs)
+    else:
+        results = (_evaluate(job) for job in jobs)
+
+    try:
+        for n, (point_number, stats) in enumerate(results, 1):
+            totals[point_number] += objective(stats)
+            generated[point_number] += 1
+            if n % 10 == 0 or n == len(jobs):
+                print 'generated {}/{}'.format(n, len(jobs))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    ranking = [(total / n_seeds, params, n) for total, params, n in zip(totals, points, generated)]
+    ranking.sort(key=lambda row: row[0], reverse=True)
+    return ranking
+
+
+def load_objective(name):
+    """A function from its 'module:function' name."""
+    module_name, function_name = name.split(':')
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def _parse_value(text):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def print_ranking(ranking, n_best=10):
+    print
+    print '-' * 10, 'BEST PARAMETERS', '-' * 10
+    for rank, (score, params, _) in enumerate(ranking[:n_best], 1):
+        print '{}. {:.4f} {}'.format(rank, score, ', '.join('{}={}'.format(k, params[k]) for k in sorted(params)))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Search Movement3 parameters, e.g. -p harmony_weight=.2,.33,.5 -p ascent_weight=1,1.5,2')
+    parser.add_argument(
+        '-p',
+        '--param',
+        help='name=value,value,... for each parameter to vary: {}'.format(
+            ', '.join(sorted(n for n in movement3.DEFAULT_PARAMS if n != 'bass_durations'))),
+        action='append',
+        default=[])
+    parser.add_argument(
+        '-r',
+        '--random',
+        help='draw this many random points, each parameter between its lowest and highest value, instead of a grid',
+        type=int)
+    parser.add_argument(
+        '-n',
+        '--seeds',
+        help='runs of each point',
+        type=int,
+        default=4)
+    parser.add_argument(
+        '-s',
+        '--seed',
+        help='seed the runs and random points come from',
+        type=int,
+        default=0)
+    parser.add_argument(
+        '-d',
+        '--duration',
+        help='length of each run in seconds',
+        type=float,
+        default=30.0)
+    parser.add_argument(
+        '-f',
+        '--objective',
+        help='module:function scoring a run\'s stats, higher is better',
+        default='candidates:score_stats')
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='number of processes, one per CPU by default',
+        type=int)
+    parser.add_argument(
+        '-c',
+        '--cache',
+        help='directory for cached stats',
+        default=DEFAULT_CACHE_DIRECTORY)
+    args = parser.parse_args()
+
+    values = {}
+    for param in args.param:
+        name, text = param.split('=')
+        if name not in movement3.DEFAULT_PARAMS:
+            parser.error('Unknown parameter: {}'.format(name))
+        values[name] = [_parse_value(v) for v in text.split(',')]
+
+    if args.random:
+        points = random_points(args.random, dict((n, (min(v), max(v))) for n, v in values.items()), args.seed)
+    else:
+        points = grid(**values)
+
+    ranking = sweep(
+        points,
+        args.seeds,
+        args.seed,
+        args.duration,
+        load_objective(args.objective),
+        args.workers,
+        args.cache
+    )
+    print_ranking(ranking)
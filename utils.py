@@ -1,19 +1,161 @@
 """Miscellaneous utils."""
 
+import re
 import random
+import hashlib
 import itertools
+from bisect import bisect_right
 from collections import Counter
 
 
 def weighted_choice(options, weights):
-    """Choose an item from options using weights."""
+    """Choose an item from options using weights.
+
+    Returns None only if no option has a positive weight.
+
+    >>> weighted_choice(['a', 'b'], [0, 1])
+    'b'
+    >>> weighted_choice([], []) is None
+    True
+
+    """
     sum_of_weights = sum(weights)
     rand = random.uniform(0, sum_of_weights)
+    if sum_of_weights <= 0:
+        return None
     total = 0
+    chosen = None
     for item, weight in zip(options, weights):
         total += weight
         if rand < total:
             return item
+        if weight > 0:
+            chosen = item
+    # Rounding can put `rand` right at the total
+    return chosen
+
+
+class WeightedSampler(object):
+    """Choose from a fixed weighted distribution, many times.
+
+    Small tables bisect the cumulative weights, which picks exactly what
+    weighted_choice would from the same random state. Tables with more than
+    ALIAS_THRESHOLD options use the alias method, which takes constant time
+    per draw.
+
+    >>> sampler = WeightedSampler(['a', 'b', 'c'], [0, 1, 0])
+    >>> sampler.choice()
+    'b'
+    >>> WeightedSampler(range(100), [0] * 99 + [1]).choice()
+    99
+    >>> WeightedSampler([], []).choice() is None
+    True
+
+    """
+    ALIAS_THRESHOLD = 64
+
+    def __init__(self, options, weights, rng=random, method=None):
+        self.rng = rng
+        pairs = [(o, float(w)) for o, w in zip(options, weights) if w > 0]
+        self.options = [o for o, _ in pairs]
+        weights = [w for _, w in pairs]
+        self.total = sum(weights)
+
+        if method is None:
+            if len(self.options) > self.ALIAS_THRESHOLD:
+                method = 'alias'
+            else:
+                method = 'bisect'
+        self.method = method
+
+        if method == 'bisect':
+            self.cumulative = []
+            total = 0
+            for weight in weights:
+                total += weight
+                self.cumulative.append(total)
+            self.choice = self._choice_bisect
+        elif method == 'alias':
+            self._make_alias_table(weights)
+            self.choice = self._choice_alias
+        else:
+            raise ValueError('Unknown sampling method: {}'.format(method))
+
+        if not self.options:
+            self.choice = lambda: None
+
+    def __len__(self):
+        return len(self.options)
+
+    def _make_alias_table(self, weights):
+        # Vose's alias method
+        n = len(weights)
+        scaled = [w * n / self.total for w in weights] if n else []
+        self.probability = [1.0] * n
+        self.alias = range(n)
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.probability[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+
+    def _choice_bisect(self):
+        rand = self.rng.uniform(0, self.total)
+        index = bisect_right(self.cumulative, rand)
+        if index == len(self.options):
+            # Rounding can put `rand` right at the total
+            index -= 1
+        return self.options[index]
+
+    def _choice_alias(self):
+        rand = self.rng.random() * len(self.options)
+        index = min(int(rand), len(self.options) - 1)
+        if rand - index < self.probability[index]:
+            return self.options[index]
+        return self.options[self.alias[index]]
+
+
+def derive_seed(tag, seed, n):
+    """The seed for the `n`th of many runs made from `seed`, the same in
+    any process. `tag` keeps different kinds of runs apart; None gives
+    the untagged seeds full_movie has always used.
+
+    >>> derive_seed('sweep', 1, 0) == derive_seed('sweep', 1, 0)
+    True
+    >>> derive_seed('sweep', 1, 0) == derive_seed('montecarlo', 1, 0)
+    False
+
+    """
+    if tag is None:
+        description = '{}:{}'.format(seed, n)
+    else:
+        description = '{}:{}:{}'.format(tag, seed, n)
+    return int(hashlib.md5(description).hexdigest()[:16], 16)
+
+
+def slugify(text, default='untitled'):
+    """`text` made safe to use as a file name: runs of anything but
+    letters, digits, spaces, dots, dashes and underscores become a dash,
+    and leading dots and surrounding spaces and dashes are dropped.
+
+    >>> slugify('Movement 3 / take 2: final?')
+    'Movement 3 - take 2- final'
+    >>> slugify('../../etc/passwd')
+    'etc-passwd'
+    >>> slugify('///')
+    'untitled'
+
+    """
+    slug = re.sub(r'[^A-Za-z0-9 ._-]+', '-', text)
+    slug = slug.lstrip('. -').rstrip(' -')
+    return slug or default
 
 
 def group(iterable, n):